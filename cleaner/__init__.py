@@ -23,6 +23,14 @@
 
 __version__ = '0.1.dev0'
 
-from . io import read_log, save_log, update_log
+from . io import read_log, save_log, update_log, compact_log, LogStore
 from . applier import reject, is_cleaned
-from . import report
\ No newline at end of file
+
+
+def __getattr__(name):
+    # The report needs matplotlib and mne.viz, only import it when used
+    if name == "report":
+        import importlib
+
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
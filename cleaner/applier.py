@@ -24,51 +24,71 @@
 from warnings import warn
 
 import mne
+import numpy as np
 from mne.utils import logger
 
 from .io import (
+    _REVIEW_KEYS,
+    LogStore,
     _check_epochs_params,
     _check_ica_params,
-    _get_json_fname,
-    read_log,
+    _decode_array,
 )
 
 
-def is_cleaned(path, kind):
+def is_cleaned(path, kind, store=None):
     if kind not in ["raws", "epochs", "icas"]:
         raise ValueError("Kind must be one of: raw, epochs or ica")
-    json_fname = _get_json_fname(path)
+    if store is None:
+        store = LogStore(path)
+    json_fname = store.json_fname
     logger.info(f"Checking if {path} is cleaned")
-    if not json_fname.exists():
+    if not store.exists():
         logger.info(f"No {json_fname} file found. Not cleaned.")
         return False
 
     logger.info(f"Checking if cleaned in {json_fname}")
-    logs = read_log(path.parent)
-    t_log = logs[kind]
+    t_log = store.logs[kind]
     if path.name not in t_log:
         logger.info(f"No log found for {path.name}. Not cleaned.")
         return False
+    if _REVIEW_KEYS[kind] not in t_log[path.name]:
+        logger.info(f"Log found for {path.name}, not reviewed. Not cleaned.")
+        return False
     logger.info(f"Log found for {path.name}. Cleaned.")
     return True
 
 
-def reject(path, inst, required=False):
+def _drop_positions(selection, prev_selection, n_events):
+    """
+    Get the positions in selection of the epochs not kept in prev_selection.
+
+    selection holds the original index of each remaining epoch, out of
+    n_events. Runs in linear time with a boolean mask of the kept epochs.
+    """
+    kept = np.zeros(n_events, dtype=bool)
+    kept[prev_selection[prev_selection < n_events]] = True
+    return np.flatnonzero(~kept[selection])
+
+
+def reject(path, inst, required=False, store=None, tolerance=0):
     """
     Apply the previously selected rejection (channels or epochs) to
     the instance
-    """
 
-    json_fname = _get_json_fname(path)
-    if not json_fname.exists() and required is True:
+    For epochs, tolerance is the number of samples by which the event
+    samples can differ from the ones in the log.
+    """
+    if store is None:
+        store = LogStore(path)
+    if not store.exists() and required is True:
         raise ValueError(
             "Missing eeg_cleaner.json. Did you clean this subject?"
         )
 
-    logs = read_log(path)
+    logs = store.logs
     if isinstance(inst, mne.io.BaseRaw):
-        fname = inst.filenames[0].name
-        t_log = logs["raws"].get(fname, {})
+        t_log = store.find("raws", inst.filenames[0])
         old_bads = t_log.get("bads", [])
         mix_bads = list(set(old_bads + inst.info["bads"]))
         inst.info["bads"] = mix_bads
@@ -77,9 +97,8 @@ def reject(path, inst, required=False):
         )
 
     elif isinstance(inst, mne.BaseEpochs):
-        fname = inst.filename
-        t_log = logs["epochs"].get(fname, {})
-        _check_epochs_params(inst, t_log)
+        t_log = store.find("epochs", inst.filename)
+        _check_epochs_params(inst, t_log, tolerance=tolerance)
         old_bads = t_log.get("bads", [])
         mix_bads = list(set(old_bads + inst.info["bads"]))
         inst.info["bads"] = mix_bads
@@ -87,16 +106,15 @@ def reject(path, inst, required=False):
             f"Setting previous bad channels {inst.info['bads']}"
         )
 
-        prev_selection = t_log.get("selection", inst.selection)
-        to_drop = [x for x in inst.selection if x not in prev_selection]
-        drop_idx = []
-        cur_idx = 0
-        for i_epoch, dlog in enumerate(inst.drop_log):
-            if len(dlog) == 0:
-                if i_epoch in to_drop:
-                    drop_idx.append(cur_idx)
-                cur_idx += 1
-        logger.info("Dropping previous bad epochs {}".format(to_drop))
+        if "selection" in t_log:
+            prev_selection = _decode_array(t_log["selection"])
+        else:
+            prev_selection = inst.selection
+        drop_idx = _drop_positions(
+            inst.selection, prev_selection, len(inst.drop_log)
+        )
+        to_drop = inst.selection[drop_idx]
+        logger.info("Dropping previous bad epochs {}".format(to_drop.tolist()))
         inst.drop(drop_idx, reason="Inspection")
     elif isinstance(inst, mne.preprocessing.ICA):
         fname = path.name
@@ -0,0 +1,190 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import mne
+import numpy as np
+from mne.utils import logger
+
+from .fingerprint import fingerprint_file
+from .io import _copy_mode
+
+
+class DiskCache:
+    """
+    Cache of arrays stored as .npy files, and of text stored as .txt files,
+    in cache_dir.
+
+    Arrays are memory-mapped when loaded. If max_size (in bytes) is set,
+    the least recently used entries are removed when the cache grows
+    beyond it.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts):
+        """
+        Build a cache key from json serializable parts.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(parts, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _fname(self, key, suffix=".npy"):
+        return self.cache_dir / f"{key}{suffix}"
+
+    def _touch(self, fname):
+        # Mark the entry as recently used
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+    def _write(self, fname, write, mode="wb"):
+        fd, tmp_fname = tempfile.mkstemp(
+            prefix=".tmp-", suffix=fname.suffix, dir=self.cache_dir
+        )
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            _copy_mode(fname, tmp_fname)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            os.unlink(tmp_fname)
+            raise
+        self._evict(keep=fname)
+
+    def load(self, key):
+        """
+        Load the array stored under key, or None if there is no such entry.
+
+        The array is mapped copy-on-write, so it can be modified in memory
+        without changing the cache.
+        """
+        fname = self._fname(key)
+        try:
+            data = np.load(fname, mmap_mode="c")
+        except (OSError, ValueError):
+            return None
+        self._touch(fname)
+        return data
+
+    def save(self, key, data):
+        """
+        Store data under key and evict the least recently used entries.
+        """
+        self._write(self._fname(key), lambda f: np.save(f, data))
+
+    def load_text(self, key):
+        """
+        Load the text stored under key, or None if there is no such entry.
+        """
+        fname = self._fname(key, ".txt")
+        try:
+            text = fname.read_text(encoding="utf-8")
+        except (OSError, ValueError):
+            return None
+        self._touch(fname)
+        return text
+
+    def save_text(self, key, text):
+        """
+        Store text under key and evict the least recently used entries.
+        """
+        self._write(
+            self._fname(key, ".txt"),
+            lambda f: f.write(text.encode("utf-8")),
+        )
+
+    def _evict(self, keep=None):
+        if self.max_size is None:
+            return
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, fname in sorted(entries):
+            if total <= self.max_size:
+                break
+            if keep is not None and fname == str(keep):
+                continue
+            try:
+                os.unlink(fname)
+            except OSError:
+                continue
+            total -= size
+            logger.info(f"Evicted {fname} from the cache")
+
+
+def filter_raw(raw, l_freq, h_freq, cache=None, preload=True):
+    """
+    Load and filter the data of a Raw instance read from a file.
+
+    If cache is a DiskCache, the filtered data is stored in it, keyed by the
+    file fingerprint and the filter parameters, and reused the next time the
+    same file is filtered with the same parameters.
+    """
+    # mne.filter imports scipy, only import it when filtering
+    from mne.filter import _filt_update_info
+
+    from .utils import load_data
+
+    if cache is None:
+        load_data(raw, preload)
+        return raw.filter(l_freq, h_freq)
+
+    fingerprint = fingerprint_file(raw.filenames[0])
+    key = cache.key(
+        "filter_raw", fingerprint["hash"], l_freq, h_freq, mne.__version__
+    )
+    data = None if raw.preload else cache.load(key)
+    if data is None:
+        load_data(raw, preload)
+        raw.filter(l_freq, h_freq)
+        cache.save(key, raw._data)
+    else:
+        logger.info(f"Using cached filtered data ({l_freq} - {h_freq})")
+        # BaseRaw.__del__ removes the file of a memmap _data, a plain view
+        # keeps the mapping without exposing the cache entry file name
+        raw._data = data.view(np.ndarray)
+        raw.preload = True
+        raw._comp = None
+        raw.close()
+        _filt_update_info(raw.info, True, l_freq, h_freq)
+    return raw
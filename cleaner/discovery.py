@@ -0,0 +1,148 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import json
+import os
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+
+from mne.utils import logger
+
+from .io import _write_json
+
+
+_MANIFEST_NAME = ".eeg_cleaner_manifest.json"
+
+# In the root of a BIDS dataset, only these directories hold data
+_BIDS_DIRS = ("sub-*", "derivatives")
+
+
+def _match(parts, pattern, partial=False):
+    """
+    Match path parts against glob pattern parts, where "**" matches any
+    number of directories.
+
+    If partial is True, check if parts are the directories of a path that
+    could still match the pattern.
+    """
+    if len(parts) == 0:
+        if partial:
+            return len(pattern) > 0
+        return all(x == "**" for x in pattern)
+    if len(pattern) == 0:
+        return False
+    if pattern[0] == "**":
+        return _match(parts, pattern[1:], partial) or _match(
+            parts[1:], pattern, partial
+        )
+    if partial and len(pattern) == 1:
+        # The last part of the pattern matches the file name
+        return False
+    if not fnmatchcase(parts[0], pattern[0]):
+        return False
+    return _match(parts[1:], pattern[1:], partial)
+
+
+def _list_dir(t_dir, cached):
+    """
+    List the subdirectories and files of t_dir.
+
+    The cached listing is reused if the directory was not modified.
+    """
+    mtime = os.stat(t_dir).st_mtime_ns
+    if cached is not None and cached["mtime"] == mtime:
+        return cached
+    dirs = []
+    files = []
+    with os.scandir(t_dir) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    return {"mtime": mtime, "dirs": sorted(dirs), "files": sorted(files)}
+
+
+def find_files(root, pattern, cache=True):
+    """
+    Find the files under root that match the glob pattern.
+
+    Equivalent to ``root.glob(pattern)``, but hidden directories are skipped
+    and, in the root of a BIDS dataset, only the subjects and derivatives
+    directories are scanned. Directories that cannot match the pattern are
+    pruned. If cache is True, the listing of each directory is stored in
+    a manifest in root, and only directories whose mtime changed are read
+    again on the next call.
+    """
+    root = Path(root)
+    pattern = PurePosixPath(pattern).parts
+    manifest_fname = root / _MANIFEST_NAME
+    manifest = {}
+    if cache and manifest_fname.exists():
+        try:
+            with open(manifest_fname, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring invalid manifest {manifest_fname}")
+
+    new_manifest = {}
+    found = []
+    n_scanned = 0
+    to_scan = [()]
+    while len(to_scan) > 0:
+        parts = to_scan.pop()
+        key = "/".join(parts)
+        try:
+            listing = _list_dir(root.joinpath(*parts), manifest.get(key))
+        except OSError as e:
+            logger.warning(f"Cannot scan {root.joinpath(*parts)}: {e}")
+            continue
+        if listing is not manifest.get(key):
+            n_scanned += 1
+        new_manifest[key] = listing
+
+        dirs = listing["dirs"]
+        if "dataset_description.json" in listing["files"]:
+            dirs = [
+                x for x in dirs if any(fnmatchcase(x, y) for y in _BIDS_DIRS)
+            ]
+        for t_name in dirs:
+            t_parts = (*parts, t_name)
+            if _match(t_parts, pattern, partial=True):
+                to_scan.append(t_parts)
+        for t_name in listing["files"]:
+            t_parts = (*parts, t_name)
+            if _match(t_parts, pattern):
+                found.append(root.joinpath(*t_parts))
+
+    logger.info(
+        f"Found {len(found)} files in {root} "
+        f"({n_scanned} of {len(new_manifest)} directories scanned)"
+    )
+    if cache:
+        try:
+            _write_json(manifest_fname, new_manifest)
+        except OSError as e:
+            logger.warning(f"Cannot write manifest {manifest_fname}: {e}")
+    return sorted(found)
@@ -0,0 +1,103 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+_CHUNK_SIZE = 1 << 20
+_N_CHUNKS = 16
+
+_fingerprints = {}
+
+
+def fingerprint_file(fname, cached=None):
+    """
+    Compute a fingerprint of the content of a file.
+
+    The file size, the first chunk (the FIF header) and evenly spaced chunks
+    up to the end of the file are hashed, so multi-GB files are fingerprinted
+    by reading a few MB. The result is a dict with the hash and the inode,
+    size and mtime of the file, and is reused (from memory or from cached,
+    e.g. the fingerprint stored in the log) while these do not change.
+    """
+    stat = os.stat(fname)
+    t_stat = {
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if cached is not None and all(
+        cached.get(k) == v for k, v in t_stat.items()
+    ):
+        return cached
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key in _fingerprints:
+        return _fingerprints[key]
+
+    size = stat.st_size
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(fname, "rb") as f:
+        if size <= _CHUNK_SIZE * (_N_CHUNKS + 2):
+            h.update(f.read())
+        else:
+            last = size - _CHUNK_SIZE
+            for i in range(_N_CHUNKS + 2):
+                f.seek(last * i // (_N_CHUNKS + 1))
+                h.update(f.read(_CHUNK_SIZE))
+    fingerprint = {"hash": h.hexdigest(), **t_stat}
+    _fingerprints[key] = fingerprint
+    return fingerprint
+
+
+def fingerprint_ica(ica):
+    """
+    Compute a fingerprint of a fitted ICA.
+
+    The unmixing, mixing and PCA matrices are hashed together with the
+    channel names, number of components, filters, sampling frequency and
+    fit parameters. Unlike the parameters alone, this changes if the ICA is
+    fitted again, e.g. with a different random seed.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for matrix in (
+        ica.unmixing_matrix_,
+        ica.mixing_matrix_,
+        ica.pca_components_,
+        ica.pca_mean_,
+    ):
+        if matrix is not None:
+            h.update(np.ascontiguousarray(matrix, dtype=np.float64).tobytes())
+    params = {
+        "ch_names": ica.ch_names,
+        "n_components": ica.n_components_,
+        "fit_params": ica.fit_params,
+        "highpass": ica.info["highpass"],
+        "lowpass": ica.info["lowpass"],
+        "sfreq": ica.info["sfreq"],
+    }
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return {"hash": h.hexdigest()}
@@ -0,0 +1,214 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import json
+import os
+from pathlib import Path
+
+from mne.utils import logger
+
+from .io import (
+    _KINDS,
+    _REVIEW_KEYS,
+    SQLiteBackend,
+    _load_log,
+    _write_json,
+    get_backend,
+)
+
+
+_LOG_NAMES = ("eeg_cleaner.json", "eeg_cleaner.jsonl")
+
+_INDEX_NAME = ".eeg_cleaner_index.json"
+
+
+def _stat_logs(t_dir):
+    """
+    Get the (mtime, size) of the json file and journal in t_dir.
+    """
+    stamp = {}
+    for name in _LOG_NAMES:
+        try:
+            stat = os.stat(os.path.join(t_dir, name))
+        except OSError:
+            continue
+        stamp[name] = [stat.st_mtime_ns, stat.st_size]
+    return stamp
+
+
+def _scan_logs(root):
+    """
+    Walk the tree once and yield the directories with a log.
+
+    Each directory is yielded with the (mtime, size) of its json file and
+    journal, which identifies the version of the log.
+    """
+    to_scan = [root]
+    while len(to_scan) > 0:
+        t_dir = to_scan.pop()
+        stamp = {}
+        try:
+            entries = list(os.scandir(t_dir))
+        except OSError as e:
+            logger.warning(f"Cannot scan {t_dir}: {e}")
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                to_scan.append(entry.path)
+            elif entry.name in _LOG_NAMES:
+                stat = entry.stat()
+                stamp[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        if len(stamp) > 0:
+            yield Path(t_dir), stamp
+
+
+class StudyIndex:
+    """
+    Cleaning status of all the files in a study.
+
+    The tree under root is scanned once and each session log is read once.
+    ``refresh`` rescans the tree and only re-reads the logs whose json file
+    or journal changed. If dirs is given, e.g. the directories of the files
+    found with ``find_files``, only the logs in these directories are
+    checked instead of walking the tree. If cache_fname is given (True
+    stores it in root), the index is also stored on disk and reused across
+    runs.
+    """
+
+    def __init__(self, root, cache_fname=None, dirs=None):
+        root = Path(root)
+        if root.is_file():
+            root = root.parent
+        self.root = root
+        if cache_fname is True:
+            cache_fname = root / _INDEX_NAME
+        self.cache_fname = None if cache_fname is None else Path(cache_fname)
+        self.dirs = None if dirs is None else sorted(set(dirs))
+        self._sessions = {}
+        if self.cache_fname is not None and self.cache_fname.exists():
+            try:
+                with open(self.cache_fname, "r") as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Ignoring invalid index {self.cache_fname}")
+                cached = {}
+            if cached.get("root") == str(self.root.resolve()):
+                self._sessions = cached["sessions"]
+        self.refresh()
+
+    def _key(self, session_dir):
+        key = os.path.relpath(Path(session_dir).resolve(), self.root.resolve())
+        return Path(key).as_posix()
+
+    def refresh(self):
+        """
+        Rescan the tree, reading only the new or modified logs.
+
+        If the logs are stored in a SQLite database, the database is queried
+        instead.
+        """
+        backend = get_backend()
+        if isinstance(backend, SQLiteBackend):
+            self._sessions = {
+                self._key(session_dir): t_session
+                for session_dir, t_session in backend.list_logs().items()
+            }
+            logger.info(
+                f"Indexed {len(self._sessions)} sessions from "
+                f"{backend.db_fname}"
+            )
+            return
+
+        if self.dirs is None:
+            sessions = {}
+            scanned = _scan_logs(self.root)
+        else:
+            # Keep the sessions indexed by other runs, e.g. with other files
+            sessions = dict(self._sessions)
+            scanned = []
+            for session_dir in self.dirs:
+                stamp = _stat_logs(session_dir)
+                if len(stamp) > 0:
+                    scanned.append((Path(session_dir), stamp))
+                else:
+                    sessions.pop(self._key(session_dir), None)
+        n_read = 0
+        for session_dir, stamp in scanned:
+            key = self._key(session_dir)
+            t_session = self._sessions.get(key)
+            if t_session is None or t_session["stamp"] != stamp:
+                logs = _load_log(session_dir / "eeg_cleaner.json")
+                t_session = {"stamp": stamp}
+                for kind in _KINDS:
+                    t_session[kind] = sorted(
+                        fname
+                        for fname, t_log in logs[kind].items()
+                        if _REVIEW_KEYS[kind] in t_log
+                    )
+                n_read += 1
+            sessions[key] = t_session
+        self._sessions = sessions
+        logger.info(
+            f"Indexed {len(sessions)} session logs in {self.root} "
+            f"({n_read} read)"
+        )
+        if self.cache_fname is not None:
+            try:
+                _write_json(
+                    self.cache_fname,
+                    {"root": str(self.root.resolve()), "sessions": sessions},
+                )
+            except OSError as e:
+                logger.warning(f"Cannot write index {self.cache_fname}: {e}")
+
+    def is_cleaned(self, path, kind):
+        """
+        Check if the file in path was reviewed for kind.
+        """
+        if kind not in _KINDS:
+            raise ValueError("Kind must be one of: raw, epochs or ica")
+        path = Path(path)
+        t_session = self._sessions.get(self._key(path.parent))
+        if t_session is None:
+            return False
+        return path.name in t_session[kind]
+
+    def status(self, path):
+        """
+        Get the cleaning status of the file in path for each kind.
+        """
+        return {kind: self.is_cleaned(path, kind) for kind in _KINDS}
+
+    def cleaned(self, kind):
+        """
+        Get the paths of all the files reviewed for kind.
+        """
+        if kind not in _KINDS:
+            raise ValueError("Kind must be one of: raw, epochs or ica")
+        return [
+            self.root / key / fname
+            for key, t_session in sorted(self._sessions.items())
+            for fname in t_session[kind]
+        ]
+
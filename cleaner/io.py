@@ -20,24 +20,109 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 #
+import base64
 import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+from contextlib import closing, contextmanager, nullcontext
+from functools import lru_cache
 from pathlib import Path
+from warnings import warn
 
 import mne
 import numpy as np
 from mne.utils import logger
 
+from .fingerprint import fingerprint_file, fingerprint_ica
+
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, logs are not locked
+    fcntl = None
+
+_KINDS = ("raws", "epochs", "icas")
+
+# Key of the log entry that is set once the file is reviewed. Entries can
+# exist before, e.g. with the scores of an automatic screening.
+_REVIEW_KEYS = {"raws": "bads", "epochs": "selection", "icas": "exclude"}
+
+# The journal is folded into the json file once it is larger than both
+# _JOURNAL_MIN_SIZE bytes and _JOURNAL_RATIO times the json file, so the
+# rewrites of the json file are amortized over many appends
+_JOURNAL_MIN_SIZE = 1 << 20
+_JOURNAL_RATIO = 2
+
+# The umask can only be read by setting it, which is not thread-safe, so it
+# is read once at import, before the prefetch threads start
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 def _get_git_hash():
     import subprocess
 
     t_path = Path(__file__).parent.resolve()
-    label = subprocess.check_output(
-        ["git", "-C", t_path, "describe", "--always"]
-    ).strip()
+    try:
+        label = subprocess.check_output(
+            ["git", "-C", t_path, "describe", "--always"],
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
     return label.decode()
 
 
+@lru_cache(maxsize=None)
+def _get_version():
+    """
+    Get the version of EEG cleaner stored in the logs.
+
+    The version is resolved once per process: first from the file written by
+    setuptools_scm at build time, then from the package metadata and only
+    then from the git repository.
+    """
+    try:
+        from ._version import version
+
+        return version
+    except ImportError:
+        pass
+
+    from importlib import metadata
+
+    try:
+        return metadata.version("cleaner")
+    except metadata.PackageNotFoundError:
+        pass
+
+    git_hash = _get_git_hash()
+    if git_hash is not None:
+        return git_hash
+
+    from . import __version__
+
+    return __version__
+
+
+def _check_version(logs):
+    version = _get_version()
+    if "config" not in logs:
+        logs["config"] = {"version": version}
+    else:
+        prev_version = logs["config"]["version"]
+        if prev_version != version:
+            logger.warning(
+                "The specified subject was cleaned with a previous "
+                f"version of EEG cleaner. ({prev_version}). The new version "
+                f"({version}) might fail."
+            )
+
+
 def _get_json_fname(path):
     if not isinstance(path, Path):
         path = Path(path)
@@ -47,108 +132,707 @@ def _get_json_fname(path):
     return json_fname
 
 
-def read_log(path):
+def _get_journal_fname(json_fname):
+    return json_fname.with_suffix(".jsonl")
+
+
+def _log_exists(json_fname):
+    return json_fname.exists() or _get_journal_fname(json_fname).exists()
+
+
+def _encode_array(values):
     """
-    Read the json file if exists, otherwise, create an "empty" file.
+    Encode an integer array as base64 of the zlib compressed differences.
+
+    Epochs selections and event samples are mostly increasing by a constant
+    step, so the differences compress to a few bytes.
     """
-    json_fname = _get_json_fname(path)
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(values, prepend=0)
+    dtype = "<i8"
+    if len(deltas) == 0 or (
+        deltas.min() >= np.iinfo(np.int32).min
+        and deltas.max() <= np.iinfo(np.int32).max
+    ):
+        dtype = "<i4"
+    data = zlib.compress(deltas.astype(dtype).tobytes())
+    return {
+        "encoding": "zlib-delta",
+        "dtype": dtype,
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+
+
+def _decode_array(value):
+    """
+    Decode an integer array stored either as a plain list or encoded with
+    ``_encode_array``.
+    """
+    if not isinstance(value, dict):
+        return np.asarray(value, dtype=np.int64)
+    if value.get("encoding") != "zlib-delta":
+        raise ValueError(f"Unknown array encoding {value.get('encoding')}")
+    data = zlib.decompress(base64.b64decode(value["data"]))
+    deltas = np.frombuffer(data, dtype=value["dtype"])
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def _lock_log(json_fname):
+    """
+    Take an advisory lock on the log of a session directory.
+
+    The lock is taken on a separate file, as the json file itself is
+    atomically replaced on every write.
+    """
+    if fcntl is None:
+        return nullcontext()
+    return _flock(json_fname.with_name(f"{json_fname.name}.lock"))
+
+
+@contextmanager
+def _flock(lock_fname):
+    with open(lock_fname, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _copy_mode(fname, tmp_fname):
+    """
+    Give a temporary file (created with mode 0600) the permissions of the
+    file it replaces, or the default permissions if it is new.
+    """
+    if os.path.exists(fname):
+        shutil.copymode(fname, tmp_fname)
+    else:
+        os.chmod(tmp_fname, 0o666 & ~_UMASK)
+
+
+def _write_json(json_fname, logs):
+    """
+    Write the json file to a temporary file and atomically replace it.
+    """
+    fd, tmp_fname = tempfile.mkstemp(
+        prefix=f".{json_fname.name}.", suffix=".tmp", dir=json_fname.parent
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(logs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _copy_mode(json_fname, tmp_fname)
+        os.replace(tmp_fname, json_fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+
+
+def _replay_journal(journal_fname, logs):
+    """
+    Apply the entries stored in the journal to the log.
+
+    A partially written last line (e.g. after a crash) is dropped.
+    """
+    with open(journal_fname, "r") as f:
+        lines = f.readlines()
+    for i_line, line in enumerate(lines):
+        if not line.endswith("\n"):
+            logger.warning(
+                f"Dropping partially written entry in {journal_fname}"
+            )
+            break
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning(
+                f"Dropping corrupted entry {i_line} in {journal_fname}"
+            )
+            continue
+        if "config" not in logs:
+            logs["config"] = {"version": record["version"]}
+        logs[record["kind"]][record["fname"]] = record["entry"]
+
+
+def _repair_journal(journal_fname):
+    """
+    Truncate a partially written last line so new entries can be appended.
+    """
+    with open(journal_fname, "rb+") as f:
+        data = f.read()
+        if len(data) == 0 or data.endswith(b"\n"):
+            return
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+def _load_log(json_fname):
     if json_fname.exists():
         with open(json_fname, "r") as f:
             logs = json.load(f)
     else:
         logs = {}
 
-    if "raws" not in logs:
-        logs["raws"] = {}
-    if "epochs" not in logs:
-        logs["epochs"] = {}
-    if "icas" not in logs:
-        logs["icas"] = {}
-    git_hash = _get_git_hash()
-    if "config" not in logs:
-        logs["config"] = {"version": git_hash}
-    else:
-        prev_hash = logs["config"]["version"]
-        if prev_hash != git_hash:
-            logger.warning(
-                "The specified subject was cleaned with a previous "
-                f"version of EEG cleaner. ({prev_hash}). The new version "
-                f"({git_hash}) might fail."
+    for kind in _KINDS:
+        if kind not in logs:
+            logs[kind] = {}
+
+    journal_fname = _get_journal_fname(json_fname)
+    if journal_fname.exists():
+        _replay_journal(journal_fname, logs)
+    return logs
+
+
+def _merge_log(json_fname, entries, version=None):
+    """
+    Merge the per-file entries with the log on disk and save it.
+
+    The journal, if any, is folded into the saved json file. A new log is
+    created with version, or the current version if None. Returns the
+    merged log.
+    """
+    journal_fname = _get_journal_fname(json_fname)
+    with _lock_log(json_fname):
+        logs = _load_log(json_fname)
+        if "config" not in logs:
+            logs["config"] = {"version": version or _get_version()}
+        for kind, t_entries in entries.items():
+            logs[kind].update(t_entries)
+        _write_json(json_fname, logs)
+        if journal_fname.exists():
+            journal_fname.unlink()
+    return logs
+
+
+def _append_journal(json_fname, entries):
+    """
+    Append the per-file entries to the journal, one json line per entry.
+
+    The journal is compacted once it grows larger than _JOURNAL_MIN_SIZE
+    and _JOURNAL_RATIO times the json file.
+    """
+    journal_fname = _get_journal_fname(json_fname)
+    version = _get_version()
+    with _lock_log(json_fname):
+        if journal_fname.exists():
+            _repair_journal(journal_fname)
+        with open(journal_fname, "a") as f:
+            for kind, t_entries in entries.items():
+                for fname, t_log in t_entries.items():
+                    record = {
+                        "kind": kind,
+                        "fname": fname,
+                        "entry": t_log,
+                        "version": version,
+                    }
+                    f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        snapshot_size = (
+            json_fname.stat().st_size if json_fname.exists() else 0
+        )
+        needs_compaction = journal_fname.stat().st_size > max(
+            _JOURNAL_MIN_SIZE, _JOURNAL_RATIO * snapshot_size
+        )
+    if needs_compaction:
+        compact_log(json_fname.parent)
+
+
+class JSONBackend:
+    """
+    Store the log of each session directory in its eeg_cleaner.json file.
+
+    If journal is True, the entries are appended to a journal
+    (eeg_cleaner.jsonl) instead of rewriting the json file. The journal is
+    replayed on read and folded into the json file by ``compact_log``.
+    """
+
+    def __init__(self, journal=False):
+        self.journal = journal
+
+    def exists(self, session_dir):
+        return _log_exists(session_dir / "eeg_cleaner.json")
+
+    def load(self, session_dir):
+        return _load_log(session_dir / "eeg_cleaner.json")
+
+    def save(self, session_dir, entries):
+        """
+        Save the per-file entries. Returns the merged log, if available.
+        """
+        json_fname = session_dir / "eeg_cleaner.json"
+        if self.journal:
+            _append_journal(json_fname, entries)
+            return None
+        return _merge_log(json_fname, entries)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS raws (
+    session TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    fingerprint TEXT,
+    n_bads INTEGER,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (session, fname)
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    session TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    fingerprint TEXT,
+    n_bads INTEGER,
+    n_events INTEGER,
+    n_selected INTEGER,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (session, fname)
+);
+CREATE TABLE IF NOT EXISTS icas (
+    session TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    n_exclude INTEGER,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (session, fname)
+);
+CREATE INDEX IF NOT EXISTS raws_fname ON raws (fname);
+CREATE INDEX IF NOT EXISTS epochs_fname ON epochs (fname);
+CREATE INDEX IF NOT EXISTS icas_fname ON icas (fname);
+"""
+
+_SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS raws_fingerprint ON raws (fingerprint);
+CREATE INDEX IF NOT EXISTS epochs_fingerprint ON epochs (fingerprint);
+"""
+
+
+class SQLiteBackend:
+    """
+    Store the logs of all the session directories of a study in a single
+    SQLite database.
+
+    There is one table per kind (raws, epochs and icas) indexed by session
+    directory, file name and content fingerprint. Each row holds the json
+    entry, with epochs selections and events always encoded (see
+    ``_encode_array``), and a few columns to query the whole study (number
+    of bad channels, of events and selected epochs, of excluded
+    components). The database is used in WAL mode so several processes can
+    update it at once.
+
+    Session directories are stored relative to the directory of the
+    database, so the study can be moved together with it.
+    """
+
+    def __init__(self, db_fname):
+        self.db_fname = Path(db_fname)
+
+    def _connect(self):
+        con = sqlite3.connect(self.db_fname, timeout=60)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(_SQLITE_SCHEMA)
+        for kind in ("raws", "epochs"):
+            columns = [x[1] for x in con.execute(f"PRAGMA table_info({kind})")]
+            if "fingerprint" not in columns:
+                con.execute(f"ALTER TABLE {kind} ADD COLUMN fingerprint TEXT")
+        con.executescript(_SQLITE_INDEXES)
+        return con
+
+    def _session_key(self, session_dir):
+        session_dir = Path(session_dir).resolve()
+        root = self.db_fname.parent.resolve()
+        if session_dir == root or root in session_dir.parents:
+            return session_dir.relative_to(root).as_posix()
+        return session_dir.as_posix()
+
+    def _session_dir(self, key):
+        return self.db_fname.parent.resolve() / key
+
+    def exists(self, session_dir):
+        key = self._session_key(session_dir)
+        with closing(self._connect()) as con:
+            row = con.execute(
+                "SELECT 1 FROM sessions WHERE session = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def load(self, session_dir):
+        key = self._session_key(session_dir)
+        logs = {kind: {} for kind in _KINDS}
+        with closing(self._connect()) as con:
+            row = con.execute(
+                "SELECT version FROM sessions WHERE session = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                logs["config"] = {"version": row[0]}
+            for kind in _KINDS:
+                rows = con.execute(
+                    f"SELECT fname, entry FROM {kind} WHERE session = ?",
+                    (key,),
+                )
+                for fname, entry in rows:
+                    logs[kind][fname] = json.loads(entry)
+        return logs
+
+    def save(self, session_dir, entries, version=None):
+        """
+        Save the per-file entries. A new session is created with version, or
+        the current version if None. Returns None, the log is not re-read.
+        """
+        key = self._session_key(session_dir)
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "INSERT OR IGNORE INTO sessions (session, version) "
+                "VALUES (?, ?)",
+                (key, version or _get_version()),
+            )
+            for kind, t_entries in entries.items():
+                for fname, t_log in t_entries.items():
+                    self._save_entry(con, key, kind, fname, t_log)
+        return None
+
+    def _save_entry(self, con, key, kind, fname, t_log):
+        t_log = dict(t_log)
+        n_bads = len(t_log.get("bads", []))
+        fingerprint = t_log.get("fingerprint", {}).get("hash")
+        if kind == "raws":
+            con.execute(
+                "INSERT OR REPLACE INTO raws (session, fname, fingerprint, "
+                "n_bads, entry) VALUES (?, ?, ?, ?, ?)",
+                (key, fname, fingerprint, n_bads, json.dumps(t_log)),
+            )
+        elif kind == "epochs":
+            n_events = None
+            n_selected = None
+            if "params" in t_log:
+                events = _decode_array(t_log["params"]["events"])
+                t_log["params"] = dict(t_log["params"])
+                t_log["params"]["events"] = _encode_array(events)
+                n_events = len(events)
+            if "selection" in t_log:
+                selection = _decode_array(t_log["selection"])
+                t_log["selection"] = _encode_array(selection)
+                n_selected = len(selection)
+            con.execute(
+                "INSERT OR REPLACE INTO epochs (session, fname, fingerprint, "
+                "n_bads, n_events, n_selected, entry) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    fname,
+                    fingerprint,
+                    n_bads,
+                    n_events,
+                    n_selected,
+                    json.dumps(t_log),
+                ),
+            )
+        else:
+            con.execute(
+                "INSERT OR REPLACE INTO icas (session, fname, n_exclude, "
+                "entry) VALUES (?, ?, ?, ?)",
+                (key, fname, len(t_log.get("exclude", [])), json.dumps(t_log)),
             )
 
-    save_log(path, logs)
+    def list_logs(self):
+        """
+        Get the reviewed file names for each kind, by session directory.
+        """
+        sessions = {}
+        with closing(self._connect()) as con:
+            for kind in _KINDS:
+                for key, fname in con.execute(
+                    f"SELECT session, fname FROM {kind} WHERE "
+                    f"json_type(entry, '$.{_REVIEW_KEYS[kind]}') IS NOT NULL"
+                ):
+                    t_session = sessions.setdefault(
+                        self._session_dir(key), {x: [] for x in _KINDS}
+                    )
+                    t_session[kind].append(fname)
+        return sessions
+
+    def import_json(self, root):
+        """
+        Import all the eeg_cleaner.json logs (and journals) under root.
+        """
+        from .index import _scan_logs
+
+        for session_dir, _ in _scan_logs(Path(root)):
+            logger.info(f"Importing log from {session_dir}")
+            logs = _load_log(session_dir / "eeg_cleaner.json")
+            # Keep the version the session was cleaned with
+            self.save(
+                session_dir,
+                {kind: logs[kind] for kind in _KINDS},
+                version=logs.get("config", {}).get("version"),
+            )
+
+    def export_json(self):
+        """
+        Write the logs of all the sessions to their eeg_cleaner.json files.
+        """
+        for session_dir in self.list_logs():
+            logger.info(f"Exporting log to {session_dir}")
+            logs = self.load(session_dir)
+            _merge_log(
+                session_dir / "eeg_cleaner.json",
+                {kind: logs[kind] for kind in _KINDS},
+                version=logs.get("config", {}).get("version"),
+            )
+
+
+_backend = None
+
+
+def set_backend(backend):
+    """
+    Set the backend used to store the logs.
+
+    If None, the logs are stored in a SQLite database if the
+    EEG_CLEANER_DB environment variable is set, otherwise in the
+    eeg_cleaner.json file of each session directory.
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    if _backend is not None:
+        return _backend
+    db_fname = os.environ.get("EEG_CLEANER_DB")
+    if db_fname:
+        return SQLiteBackend(db_fname)
+    return JSONBackend()
+
+
+def read_log(path):
+    """
+    Read the log if exists, otherwise, return an "empty" log.
+    """
+    logs = get_backend().load(_get_json_fname(path).parent)
+    _check_version(logs)
 
     return logs
 
 
 def save_log(path, logs):
     """
-    Save the json file, ensuring all the needed keys are there
+    Save the log, ensuring all the needed keys are there.
+
+    The entries in logs are merged, file by file, with the ones that other
+    processes might have saved in the meantime.
+    """
+    session_dir = _get_json_fname(path).parent
+
+    for kind in _KINDS:
+        if kind not in logs:
+            logs[kind] = {}
+    _check_version(logs)
+    get_backend().save(session_dir, {kind: logs[kind] for kind in _KINDS})
+
+
+def compact_log(path):
+    """
+    Fold the journal into the json file and remove it.
     """
     json_fname = _get_json_fname(path)
+    if not _get_journal_fname(json_fname).exists():
+        return
+    logger.info(f"Compacting log for {path}")
+    _merge_log(json_fname, {})
 
-    if "raws" not in logs:
-        logs["raws"] = {}
-    if "epochs" not in logs:
-        logs["epochs"] = {}
-    if "icas" not in logs:
-        logs["icas"] = {}
-    git_hash = _get_git_hash()
-    if "config" not in logs:
-        logs["config"] = {"version": git_hash}
-    else:
-        prev_hash = logs["config"]["version"]
-        if prev_hash != git_hash:
-            logger.warning(
-                "The specified subject was cleaned with a previous "
-                f"version of EEG cleaner. ({prev_hash}). The new version "
-                f"({git_hash}) might fail."
-            )
-    with open(json_fname, "w") as f:
-        json.dump(logs, f)
 
+class LogStore:
+    """
+    In-memory view of the log of a session directory.
+
+    The log is read once, on first access. Entries modified with ``set``
+    are tracked and written back only on ``commit`` or when leaving the
+    context manager without errors. Only the modified entries are merged
+    with the stored log, so updates from other processes are kept.
+
+    The log is stored with the backend (see ``set_backend``). If journal is
+    True, a JSONBackend with a journal is used instead.
 
-def update_log(path, inst):
+    If compact is True, epochs selections and event samples are stored
+    encoded (see ``_encode_array``) instead of as plain lists.
     """
-    Update the log and save the json file
+
+    def __init__(self, path, journal=False, compact=False, backend=None):
+        self.json_fname = _get_json_fname(path)
+        self.session_dir = self.json_fname.parent
+        if backend is None:
+            backend = JSONBackend(journal=True) if journal else get_backend()
+        self.backend = backend
+        self.compact = compact
+        self._logs = None
+        self._dirty = set()
+        self._fingerprints = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    @property
+    def logs(self):
+        if self._logs is None:
+            self._logs = self.backend.load(self.session_dir)
+            _check_version(self._logs)
+        return self._logs
+
+    @property
+    def dirty(self):
+        return len(self._dirty) > 0
+
+    def exists(self):
+        """
+        Check if the log is stored or has pending changes.
+        """
+        return self.dirty or self.backend.exists(self.session_dir)
+
+    def get(self, kind, fname, default=None):
+        return self.logs[kind].get(fname, default)
+
+    def set(self, kind, fname, t_log):
+        self.logs[kind][fname] = t_log
+        self._dirty.add((kind, fname))
+        if self._fingerprints is not None and "fingerprint" in t_log:
+            self._fingerprints[kind][t_log["fingerprint"]["hash"]] = fname
+
+    def _find_fingerprint(self, kind, fingerprint):
+        if self._fingerprints is None:
+            self._fingerprints = {x: {} for x in _KINDS}
+            for t_kind in ("raws", "epochs"):
+                for fname, t_log in self.logs[t_kind].items():
+                    if "fingerprint" in t_log:
+                        t_hash = t_log["fingerprint"]["hash"]
+                        self._fingerprints[t_kind][t_hash] = fname
+        return self._fingerprints[kind].get(fingerprint["hash"])
+
+    def find(self, kind, fname):
+        """
+        Get the log entry of the raw or epochs file in fname.
+
+        The entry is looked up by name and, if not found, by the fingerprint
+        of the content (e.g. the file was renamed). A warning is emitted if
+        the content of the file changed since it was logged. Instances not
+        read from a file (fname is None) have no entry.
+        """
+        if fname is None:
+            return {}
+        fname = Path(fname)
+        t_log = self.get(kind, fname.name)
+        if not fname.is_file():
+            return {} if t_log is None else t_log
+        cached = None if t_log is None else t_log.get("fingerprint")
+        fingerprint = fingerprint_file(fname, cached=cached)
+        if t_log is not None:
+            if cached is not None and cached["hash"] != fingerprint["hash"]:
+                warn(
+                    f"The content of {fname.name} changed since it was "
+                    "cleaned. The logged decisions might not apply.",
+                    stacklevel=2,
+                )
+            return t_log
+        prev_fname = self._find_fingerprint(kind, fingerprint)
+        if prev_fname is None:
+            return {}
+        logger.warning(
+            f"No log found for {fname.name}, using the log of {prev_fname} "
+            "which has the same content."
+        )
+        return self.get(kind, prev_fname)
+
+    def commit(self):
+        """
+        Write the pending changes with the backend.
+        """
+        if not self.dirty:
+            return
+        entries = {}
+        for kind, fname in self._dirty:
+            entries.setdefault(kind, {})[fname] = self.logs[kind][fname]
+        logs = self.backend.save(self.session_dir, entries)
+        if logs is not None:
+            self._logs = logs
+            self._fingerprints = None
+        self._dirty.clear()
+
+
+def update_log(
+    path, inst, store=None, journal=False, compact=False, tolerance=0
+):
+    """
+    Update the log and save the json file.
+
+    If a LogStore is given, the log is updated in memory and written when
+    the store is committed. Otherwise, a LogStore is created with the
+    journal and compact options.
+
+    For epochs, tolerance is the number of samples by which the event
+    samples can differ from the ones in the log.
     """
+    if store is None:
+        with LogStore(path, journal=journal, compact=compact) as store:
+            update_log(path, inst, store=store, tolerance=tolerance)
+        return
+
     logger.info(f"Updating log for {path}")
-    logs = read_log(path)
     if isinstance(inst, mne.io.BaseRaw):
         fname = inst.filenames[0].name
-        t_log = logs["raws"].get(fname, {})
+        t_log = store.get("raws", fname, {})
+        _update_fingerprint(inst.filenames[0], t_log)
         t_log["bads"] = inst.info["bads"]
         logger.info(f"Updating bad channels {t_log['bads']}")
-        if fname not in logs["raws"]:
-            logs["raws"][fname] = t_log
+        store.set("raws", fname, t_log)
     elif isinstance(inst, mne.BaseEpochs):
         fname = inst.filename.name
-        t_log = logs["epochs"].get(fname, {})
-        _check_epochs_params(inst, t_log)
+        t_log = store.get("epochs", fname, {})
+        _update_fingerprint(inst.filename, t_log)
+        _check_epochs_params(inst, t_log, tolerance=tolerance)
         t_log["bads"] = inst.info["bads"]
         logger.info(f"Updating bad channels {t_log['bads']}")
 
-        t_log["selection"] = inst.selection.tolist()
+        if store.compact:
+            t_log["selection"] = _encode_array(inst.selection)
+            t_log["params"]["events"] = _encode_array(
+                _decode_array(t_log["params"]["events"])
+            )
+        else:
+            t_log["selection"] = inst.selection.tolist()
         dropped = [
             i
             for i, x in enumerate(inst.drop_log)
             if "Inspection" in x or "USER" in x
         ]
         logger.info(f"Updating bad epochs {dropped}")
-
-        if fname not in logs["epochs"]:
-            logs["epochs"][fname] = t_log
+        store.set("epochs", fname, t_log)
     elif isinstance(inst, mne.preprocessing.ICA):
         fname = path.name
-        t_log = logs["icas"].get(fname, {})
+        t_log = store.get("icas", fname, {})
         _check_ica_params(inst, t_log)
         t_log["exclude"] = inst.exclude
-        if fname not in logs["icas"]:
-            logs["icas"][fname] = t_log
-    save_log(path, logs)
+        store.set("icas", fname, t_log)
+
 
+def _update_fingerprint(fname, t_log):
+    fingerprint = fingerprint_file(fname, cached=t_log.get("fingerprint"))
+    if "fingerprint" in t_log and (
+        t_log["fingerprint"]["hash"] != fingerprint["hash"]
+    ):
+        logger.warning(
+            f"The content of {fname.name} changed since it was cleaned. "
+            "Updating the fingerprint in the log."
+        )
+    t_log["fingerprint"] = fingerprint
 
-def _check_epochs_params(epochs, t_log):
+
+def _check_epochs_params(epochs, t_log, tolerance=0):
     if "params" not in t_log:
         t_log["params"] = {
             "tmin": epochs.tmin,
@@ -168,19 +852,48 @@ def _check_epochs_params(epochs, t_log):
             )
 
         # Check events (saved events is subset of epochs.events)
-        this_selection = epochs.selection
-        prev_selection = t_log.get("selection", np.arange(len(epochs)))
-        inter = np.intersect1d(this_selection, prev_selection)
-        this_events = epochs.events[:, 0].tolist()
-        to_check = [
-            this_events[i] for i, x in enumerate(this_selection) if x in inter
-        ]
-        prev_events = t_log["params"]["events"]
-        if not all(x in prev_events for x in to_check):
-            raise ValueError("Epochs event samples do not match")
+        if "selection" in t_log:
+            prev_selection = _decode_array(t_log["selection"])
+        else:
+            prev_selection = np.arange(len(epochs))
+        mask = np.isin(epochs.selection, prev_selection)
+        to_check = epochs.events[mask, 0]
+        prev_events = np.sort(_decode_array(t_log["params"]["events"]))
+        missing = _find_missing_events(to_check, prev_events, tolerance)
+        if np.any(missing):
+            mismatches = dict(
+                zip(
+                    epochs.selection[mask][missing].tolist(),
+                    to_check[missing].tolist(),
+                )
+            )
+            logger.error(
+                f"Epochs event samples not found in the log: {mismatches}"
+            )
+            raise ValueError(
+                "Epochs event samples do not match: "
+                f"{len(mismatches)} of {len(to_check)} events not found "
+                f"(tolerance {tolerance} samples). First mismatches "
+                f"(epoch: sample): {dict(list(mismatches.items())[:10])}"
+            )
+
+
+def _find_missing_events(events, prev_events, tolerance=0):
+    """
+    Find the events that are not within tolerance samples of any of the
+    (sorted) previous events.
+    """
+    if len(prev_events) == 0:
+        return np.ones(len(events), dtype=bool)
+    idx = np.searchsorted(prev_events, events)
+    left = prev_events[np.maximum(idx - 1, 0)]
+    right = prev_events[np.minimum(idx, len(prev_events) - 1)]
+    distance = np.minimum(np.abs(events - left), np.abs(right - events))
+    return distance > tolerance
 
 
 def _check_ica_params(ica, t_log):
+    fingerprint = fingerprint_ica(ica)
     if "params" not in t_log:
         t_log["params"] = {
             "ch_names": ica.ch_names,
@@ -190,7 +903,9 @@ def _check_ica_params(ica, t_log):
             "lowpass": ica.info["lowpass"],
             "sfreq": ica.info["sfreq"],
         }
-    else:
+        t_log["fingerprint"] = fingerprint
+    elif t_log.get("fingerprint") != fingerprint:
+        # Find out what changed
         if ica.ch_names != t_log["params"]["ch_names"]:
             raise ValueError("ICA channels names do not match.")
         if ica.fit_params != t_log["params"]["fit_params"]:
@@ -204,3 +919,11 @@ def _check_ica_params(ica, t_log):
             raise ValueError("ICA lowpass filter do not match.")
         if ica.info["sfreq"] != t_log["params"]["sfreq"]:
             raise ValueError("ICA sample frequency do not match.")
+        if "fingerprint" in t_log:
+            raise ValueError(
+                "ICA decomposition does not match. The parameters are the "
+                "same, but the ICA was fitted again (e.g. with a different "
+                "random seed), so the excluded components do not apply."
+            )
+        # Logged before fingerprints were stored
+        t_log["fingerprint"] = fingerprint
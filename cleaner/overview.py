@@ -0,0 +1,241 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from mne.utils import logger
+
+from .fingerprint import fingerprint_file
+from .io import _copy_mode
+
+
+class MinMaxPyramid:
+    """
+    Per-channel minimum and maximum of a recording at several resolutions.
+
+    Level 0 holds the min/max of each bin of bin_size samples, and each
+    following level halves the number of bins. Levels are arrays of shape
+    (2, n_channels, n_bins) with the minima and maxima.
+    """
+
+    def __init__(self, levels, bin_size, sfreq, ch_names, fingerprint=None):
+        self._levels = levels
+        self.n_levels = len(levels)
+        self.bin_size = int(bin_size)
+        self.sfreq = float(sfreq)
+        self.ch_names = list(ch_names)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_raw(cls, raw, bin_duration=0.25, chunk_duration=60.0):
+        """
+        Build the pyramid in a single pass over the data of raw.
+
+        The data is read chunk_duration seconds at a time, so raw does not
+        need to be loaded in memory.
+        """
+        sfreq = raw.info["sfreq"]
+        n_times = raw.n_times
+        n_chans = raw.info["nchan"]
+        bin_size = max(1, round(float(bin_duration * sfreq)))
+        n_bins = -(-n_times // bin_size)
+        chunk = bin_size * max(1, int(chunk_duration / bin_duration))
+
+        base = np.empty((2, n_chans, n_bins), dtype=np.float32)
+        for start in range(0, n_times, chunk):
+            stop = min(start + chunk, n_times)
+            data = raw.get_data(start=start, stop=stop)
+            first = start // bin_size
+            n_full = data.shape[1] // bin_size
+            full = data[:, : n_full * bin_size].reshape(
+                n_chans, n_full, bin_size
+            )
+            base[0, :, first : first + n_full] = full.min(axis=-1)
+            base[1, :, first : first + n_full] = full.max(axis=-1)
+            if n_full * bin_size < data.shape[1]:
+                # Last, partial bin
+                rest = data[:, n_full * bin_size :]
+                base[0, :, first + n_full] = rest.min(axis=-1)
+                base[1, :, first + n_full] = rest.max(axis=-1)
+
+        levels = [base]
+        while levels[-1].shape[-1] > 1:
+            prev = levels[-1]
+            if prev.shape[-1] % 2 == 1:
+                prev = np.concatenate([prev, prev[..., -1:]], axis=-1)
+            pairs = prev.reshape(2, n_chans, -1, 2)
+            levels.append(
+                np.stack([pairs[0].min(axis=-1), pairs[1].max(axis=-1)])
+            )
+        return cls(levels, bin_size, sfreq, raw.ch_names)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Read a pyramid saved with save. Levels are read when used.
+        """
+        npz = np.load(fname)
+        n_levels = int(npz["n_levels"])
+        levels = _LazyLevels(npz, n_levels)
+        fingerprint = str(npz["fingerprint"]) or None
+        return cls(
+            levels,
+            npz["bin_size"],
+            npz["sfreq"],
+            npz["ch_names"].tolist(),
+            fingerprint=fingerprint,
+        )
+
+    def save(self, fname):
+        """
+        Write the pyramid to a .npz file.
+        """
+        fname = Path(fname)
+        arrays = {f"level{i}": self._levels[i] for i in range(self.n_levels)}
+        fd, tmp_fname = tempfile.mkstemp(
+            prefix=f".{fname.name}-", suffix=".npz", dir=fname.parent
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    n_levels=self.n_levels,
+                    bin_size=self.bin_size,
+                    sfreq=self.sfreq,
+                    ch_names=np.array(self.ch_names),
+                    fingerprint=self.fingerprint or "",
+                    **arrays,
+                )
+            _copy_mode(fname, tmp_fname)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            os.unlink(tmp_fname)
+            raise
+
+    def get(self, tmin=None, tmax=None, n_bins=2000):
+        """
+        Get the min/max between tmin and tmax with at least n_bins bins.
+
+        The coarsest level with enough bins is used. Returns the start time
+        of each bin, and the minima and maxima, of shape
+        (n_channels, n_bins).
+        """
+        for level in range(self.n_levels - 1, -1, -1):
+            bin_duration = self.bin_size * 2**level / self.sfreq
+            data = self._levels[level]
+            first = 0 if tmin is None else int(tmin / bin_duration)
+            last = data.shape[-1] if tmax is None else int(tmax / bin_duration)
+            first = max(first, 0)
+            last = min(max(last, first + 1), data.shape[-1])
+            if last - first >= n_bins or level == 0:
+                break
+        times = np.arange(first, last) * bin_duration
+        return times, data[0, :, first:last], data[1, :, first:last]
+
+
+class _LazyLevels:
+    def __init__(self, npz, n_levels):
+        self._npz = npz
+        self._n_levels = n_levels
+        self._cache = {}
+
+    def __len__(self):
+        return self._n_levels
+
+    def __getitem__(self, level):
+        if level not in self._cache:
+            self._cache[level] = self._npz[f"level{level}"]
+        return self._cache[level]
+
+
+def _get_pyramid_fname(fname):
+    fname = Path(fname)
+    return fname.parent / fname.name.replace(".fif", "-minmax.npz")
+
+
+def get_pyramid(raw, bin_duration=0.25):
+    """
+    Get the min/max pyramid of a Raw instance read from a file.
+
+    The pyramid is stored next to the file and rebuilt if the content of
+    the file changed.
+    """
+    fname = raw.filenames[0]
+    fingerprint = fingerprint_file(fname)["hash"]
+    pyramid_fname = _get_pyramid_fname(fname)
+    if pyramid_fname.exists():
+        try:
+            pyramid = MinMaxPyramid.load(pyramid_fname)
+        except (OSError, ValueError, KeyError):
+            logger.warning(f"Ignoring invalid pyramid {pyramid_fname}")
+        else:
+            if pyramid.fingerprint == fingerprint:
+                return pyramid
+    logger.info(f"Building min/max pyramid of {fname}")
+    pyramid = MinMaxPyramid.from_raw(raw, bin_duration=bin_duration)
+    pyramid.fingerprint = fingerprint
+    try:
+        pyramid.save(pyramid_fname)
+    except OSError as e:
+        logger.warning(f"Cannot write pyramid {pyramid_fname}: {e}")
+    return pyramid
+
+
+def plot_overview(
+    pyramid, bads=(), tmin=None, tmax=None, n_bins=2000, scaling=30e-6
+):
+    """
+    Plot the min/max envelope of all the channels over time.
+
+    Each channel is centered on its median and clipped at 2 * scaling, so
+    drifts, flat channels and bursts stand out. Bad channels are plotted
+    in red.
+    """
+    import matplotlib.pyplot as plt
+
+    times, mins, maxs = pyramid.get(tmin, tmax, n_bins=n_bins)
+    center = np.median((mins + maxs) / 2, axis=-1, keepdims=True)
+    mins = np.clip((mins - center) / (4 * scaling), -0.5, 0.5)
+    maxs = np.clip((maxs - center) / (4 * scaling), -0.5, 0.5)
+
+    n_chans = len(pyramid.ch_names)
+    fig, ax = plt.subplots(figsize=(12, max(4, n_chans * 0.15)))
+    for i_ch, ch_name in enumerate(pyramid.ch_names):
+        color = "red" if ch_name in bads else "black"
+        offset = n_chans - 1 - i_ch
+        ax.fill_between(
+            times,
+            offset + mins[i_ch],
+            offset + maxs[i_ch],
+            color=color,
+            linewidth=0,
+            step="post",
+        )
+    ax.set_yticks(np.arange(n_chans))
+    ax.set_yticklabels(pyramid.ch_names[::-1], fontsize=6)
+    ax.set_ylim(-1, n_chans)
+    ax.set_xlabel("Time (s)")
+    ax.set_title("Min/max overview")
+    return fig
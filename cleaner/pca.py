@@ -0,0 +1,149 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import mne
+import numpy as np
+from mne.utils import logger
+
+from .fingerprint import fingerprint_file
+
+
+def _iter_chunks(epochs, picks, n_epochs):
+    for start in range(0, len(epochs), n_epochs):
+        stop = min(start + n_epochs, len(epochs))
+        data = epochs.get_data(picks=picks, item=slice(start, stop))
+        yield start, stop, data
+
+
+def fit_pca(epochs, picks, n_components, n_epochs=100):
+    """
+    Fit a PCA over the channels in picks, with the samples of all the
+    epochs as observations.
+
+    The epochs are read n_epochs at a time and fitted incrementally, so
+    the data does not need to be loaded in memory. Returns the mean, of
+    shape (n_picks,), and the components, of shape (n_components, n_picks).
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    pca = IncrementalPCA(n_components)
+    for _, _, data in _iter_chunks(epochs, picks, n_epochs):
+        pca.partial_fit(data.transpose(0, 2, 1).reshape(-1, len(picks)))
+    return pca.mean_, pca.components_
+
+
+def make_pca_epochs(epochs, n_components, preload=True, cache=None):
+    """
+    Make epochs with the PCA components appended to the channels of epochs.
+
+    Two blank channels and the n_components PCA sources of the good EEG
+    channels are added as misc channels. The data of epochs is copied once,
+    in blocks, into the new epochs, which are memory-mapped if preload is
+    a file name. If cache is a DiskCache, the components and sources are
+    stored in it, keyed by the file, bad channels, selected epochs and
+    n_components, and reused when the file is opened again.
+
+    Decisions taken on the returned epochs can be copied back with
+    copy_decisions.
+    """
+    # mne._fiff.meas_info imports scipy, only import it when used
+    from mne._fiff.meas_info import _merge_info
+
+    picks = mne.pick_types(
+        epochs.info, meg=False, eeg=True, eog=False, stim=False, exclude="bads"
+    )
+    n_chans = epochs.info["nchan"]
+    n_epochs = 100
+    shape = (len(epochs), n_chans + 2 + n_components, len(epochs.times))
+
+    key = None
+    components = None
+    sources = None
+    if cache is not None:
+        key = cache.key(
+            "make_pca_epochs",
+            fingerprint_file(epochs.filename)["hash"],
+            sorted(epochs.info["bads"]),
+            epochs.selection.tolist(),
+            n_components,
+        )
+        components = cache.load(f"{key}-components")
+        sources = cache.load(f"{key}-sources")
+    if components is None:
+        logger.info(f"Fitting PCA (n_pca = {n_components})")
+        mean, components = fit_pca(epochs, picks, n_components, n_epochs)
+        components = np.concatenate([mean[None], components])
+        if cache is not None:
+            cache.save(f"{key}-components", components)
+    else:
+        logger.info("Using cached PCA components")
+    mean, components = components[0], components[1:]
+
+    if preload is True:
+        data = np.empty(shape)
+    else:
+        data = np.memmap(preload, mode="w+", dtype=np.float64, shape=shape)
+    data[:, n_chans : n_chans + 2] = 0
+    compute_sources = sources is None
+    for start, stop, t_data in _iter_chunks(epochs, None, n_epochs):
+        data[start:stop, :n_chans] = t_data
+        if compute_sources:
+            t_data = t_data[:, picks] - mean[None, :, None]
+            data[start:stop, n_chans + 2 :] = np.einsum(
+                "kc,ect->ekt", components, t_data
+            )
+    if compute_sources:
+        if cache is not None:
+            cache.save(f"{key}-sources", data[:, n_chans + 2 :])
+    else:
+        logger.info("Using cached PCA sources")
+        data[:, n_chans + 2 :] = sources
+
+    ch_names = ["Blank1", "Blank2"]
+    ch_names += [f"PCA{x}" for x in range(n_components)]
+    pca_info = mne.create_info(ch_names, epochs.info["sfreq"], "misc")
+    info = _merge_info([epochs.info, pca_info], force_update_to_first=True)
+    return mne.EpochsArray(
+        data,
+        info,
+        events=epochs.events,
+        tmin=epochs.tmin,
+        event_id=epochs.event_id,
+        metadata=epochs.metadata,
+        selection=epochs.selection,
+        drop_log=epochs.drop_log,
+        raw_sfreq=epochs._raw_sfreq,
+        verbose=False,
+    )
+
+
+def copy_decisions(pca_epochs, epochs):
+    """
+    Copy the bad channels and the dropped epochs of pca_epochs to epochs.
+    """
+    epochs.info["bads"] = [
+        x for x in pca_epochs.info["bads"] if x in epochs.ch_names
+    ]
+    kept = np.isin(epochs.selection, pca_epochs.selection)
+    if not kept.all():
+        epochs.drop(np.flatnonzero(~kept), reason="USER")
+    return epochs
@@ -0,0 +1,153 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import atexit
+import os
+import threading
+from contextlib import ExitStack
+
+from mne.utils import logger
+
+
+# Loads whose resources are not released yet
+_open_loads = set()
+_open_lock = threading.Lock()
+
+
+class _Load(threading.Thread):
+    """
+    Call load(fname, stack, cancelled) in a daemon thread.
+
+    The resources registered in stack are released by close(), or as soon
+    as the load finishes if it was cancelled before. cancelled is a
+    threading.Event set by cancel().
+    """
+
+    def __init__(self, fname, load):
+        super().__init__(name=f"prefetch {fname}", daemon=True)
+        self.fname = fname
+        self.load = load
+        self.stack = ExitStack()
+        self.cancelled = threading.Event()
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._done = False
+        with _open_lock:
+            _open_loads.add(self)
+
+    def run(self):
+        # Any error is kept, get() raises it again in the caller thread
+        try:
+            self.result = self.load(self.fname, self.stack, self.cancelled)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+        finally:
+            with self._lock:
+                self._done = True
+                if self.cancelled.is_set():
+                    self.close()
+
+    def get(self):
+        if self.ident is None:
+            # Not prefetched, load in the caller thread (where Ctrl-C stops
+            # it) and release the resources if it is interrupted
+            try:
+                self.run()
+            except BaseException:
+                self.close()
+                raise
+        else:
+            self.join()
+        if self.error is not None:
+            self.close()
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            if self._done:
+                self.close()
+
+    def close(self):
+        self.stack.close()
+        with _open_lock:
+            _open_loads.discard(self)
+
+
+@atexit.register
+def _close_loads():
+    # Daemon threads are killed when the interpreter exits, so wait for the
+    # pending loads to release their resources (e.g. memmap scratch files).
+    # Once cancelled, a load stops at its next check of the event.
+    with _open_lock:
+        loads = list(_open_loads)
+    for t_load in loads:
+        t_load.cancel()
+        if t_load.is_alive():
+            logger.info(f"Waiting for the prefetch of {t_load.fname}")
+            t_load.join()
+        t_load.close()
+
+
+def prefetch(fnames, load, max_bytes=None):
+    """
+    Iterate over (fname, load(fname, stack, cancelled)) for each file.
+
+    While the caller works on one file, the next one is loaded in a
+    background thread. stack is an ExitStack to register cleanups (e.g.
+    scratch files) that run when the caller moves on to the next file.
+    cancelled is a threading.Event, set when the load is not needed anymore;
+    load should check it between long steps and return early (the result
+    is discarded).
+    If max_bytes is set, the next file is only prefetched if the size of
+    both files fits in it; otherwise it is loaded when needed. If the
+    iteration stops early, a pending prefetch is cancelled. Its resources
+    are released when it finishes, or at exit after waiting for it.
+    """
+    fnames = list(fnames)
+    pending = None
+    try:
+        for i_file, fname in enumerate(fnames):
+            if pending is not None:
+                if pending.is_alive():
+                    logger.info(f"Waiting for {fname} to be prefetched")
+                current, pending = pending, None
+            else:
+                current = _Load(fname, load)
+            result = current.get()
+
+            if i_file + 1 < len(fnames):
+                next_fname = fnames[i_file + 1]
+                size = os.path.getsize(fname) + os.path.getsize(next_fname)
+                if max_bytes is None or size <= max_bytes:
+                    logger.info(f"Prefetching {next_fname}")
+                    pending = _Load(next_fname, load)
+                    pending.start()
+            try:
+                yield fname, result
+            finally:
+                current.close()
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,323 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import mne
+import numpy as np
+from mne.utils import logger
+
+from .fingerprint import fingerprint_file
+from .io import _update_fingerprint
+
+
+def _robust_z(x):
+    median = np.nanmedian(x)
+    mad = 1.4826 * np.nanmedian(np.abs(x - median))
+    if mad == 0:
+        mad = np.finfo(float).eps
+    return (x - median) / mad
+
+
+def _neighbors(info, picks, corr, n_neighbors):
+    """
+    Get the indices of the n_neighbors closest channels of each channel.
+
+    Without channel positions, the most correlated channels are used.
+    """
+    n_chans = len(picks)
+    n_neighbors = min(n_neighbors, n_chans - 1)
+    pos = np.array([info["chs"][x]["loc"][:3] for x in picks])
+    if np.all(np.isfinite(pos)) and np.any(pos != 0):
+        dist = np.linalg.norm(pos[:, None] - pos[None], axis=-1)
+    else:
+        dist = -np.abs(corr)
+    dist = dist.copy()
+    np.fill_diagonal(dist, np.inf)
+    return np.argsort(dist, axis=1)[:, :n_neighbors]
+
+
+def screen_channels(
+    raw,
+    chunk_duration=30.0,
+    l_freq=1.0,
+    hf_freq=50.0,
+    flat_tol=1e-12,
+    n_neighbors=6,
+):
+    """
+    Compute robust statistics of each EEG channel in one pass over raw.
+
+    The data is read chunk_duration seconds at a time, so raw does not need
+    to be loaded in memory, and high-passed at l_freq. The scores are:
+
+    - variance: variance of the high-passed signal.
+    - flat: fraction of consecutive samples differing by less than
+      flat_tol.
+    - hf_noise: fraction of the variance above hf_freq.
+    - neighbor_corr: median correlation with the n_neighbors closest
+      channels.
+    """
+    # scipy is slow to import, only import it when screening
+    from scipy.signal import butter, sosfilt, sosfilt_zi
+
+    info = raw.info
+    picks = mne.pick_types(info, eeg=True, exclude=[])
+    if len(picks) < 2:
+        raise ValueError("At least two EEG channels are needed to screen.")
+    sfreq = info["sfreq"]
+    n_chans = len(picks)
+    sos_low = butter(4, l_freq, "highpass", fs=sfreq, output="sos")
+    sos_high = None
+    if hf_freq < sfreq / 2:
+        sos_high = butter(4, hf_freq, "highpass", fs=sfreq, output="sos")
+
+    zi_low = None
+    zi_high = None
+    if sos_high is not None:
+        zi_high = np.zeros((sos_high.shape[0], n_chans, 2))
+    n_samples = 0
+    n_flat = np.zeros(n_chans)
+    last = None
+    x_sum = np.zeros(n_chans)
+    xx_sum = np.zeros((n_chans, n_chans))
+    hf_sum = np.zeros(n_chans)
+    chunk = max(1, int(chunk_duration * sfreq))
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        data = raw.get_data(picks=picks, start=start, stop=stop)
+
+        if last is not None:
+            data_diff = np.diff(np.concatenate([last, data], axis=1))
+        else:
+            data_diff = np.diff(data)
+        n_flat += np.sum(np.abs(data_diff) < flat_tol, axis=1)
+        last = data[:, -1:]
+
+        if zi_low is None:
+            # Start in steady state to avoid the transient of the offset
+            zi_low = sosfilt_zi(sos_low)[:, None, :] * data[None, :, :1]
+        data, zi_low = sosfilt(sos_low, data, zi=zi_low)
+        n_samples += data.shape[1]
+        x_sum += data.sum(axis=1)
+        xx_sum += data @ data.T
+        if sos_high is not None:
+            data, zi_high = sosfilt(sos_high, data, zi=zi_high)
+            hf_sum += np.sum(data**2, axis=1)
+
+    mean = x_sum / n_samples
+    cov = (xx_sum - n_samples * np.outer(mean, mean)) / max(n_samples - 1, 1)
+    variance = np.diag(cov).copy()
+    std = np.sqrt(variance)
+    std[std == 0] = np.inf
+    corr = cov / np.outer(std, std)
+    neighbors = _neighbors(info, picks, corr, n_neighbors)
+    neighbor_corr = np.median(
+        np.take_along_axis(corr, neighbors, axis=1), axis=1
+    )
+    if sos_high is not None:
+        hf_noise = hf_sum / n_samples / np.where(variance > 0, variance, 1)
+    else:
+        hf_noise = np.full(n_chans, np.nan)
+
+    return {
+        "ch_names": [info["ch_names"][x] for x in picks],
+        "variance": variance,
+        "flat": n_flat / max(raw.n_times - 1, 1),
+        "hf_noise": hf_noise,
+        "neighbor_corr": neighbor_corr,
+    }
+
+
+def suggest_bads(scores, z_thresh=5.0, max_flat=0.1, min_corr=0.4):
+    """
+    Get the channels to suggest as bad from the scores of screen_channels.
+
+    Returns a dict with the reasons (flat, variance, hf_noise or
+    correlation) for each suggested channel.
+    """
+    flat = np.asarray(scores["flat"])
+    log_variance = np.log10(np.maximum(scores["variance"], 1e-30))
+    reasons = {
+        "flat": flat > max_flat,
+        "variance": np.abs(_robust_z(log_variance)) > z_thresh,
+        "hf_noise": _robust_z(np.asarray(scores["hf_noise"])) > z_thresh,
+        "correlation": np.asarray(scores["neighbor_corr"]) < min_corr,
+    }
+    suggested = {}
+    for i_ch, ch_name in enumerate(scores["ch_names"]):
+        t_reasons = [k for k, v in reasons.items() if v[i_ch]]
+        if len(t_reasons) > 0:
+            suggested[ch_name] = t_reasons
+    return suggested
+
+
+def prescreen_raw(raw, store, **kwargs):
+    """
+    Screen the channels of a Raw instance read from a file and record the
+    scores and suggested bad channels in the log.
+
+    If the log already has a screening of the same file content with the
+    same parameters, it is reused. kwargs are passed to screen_channels.
+    Returns the suggested bad channels, as in suggest_bads.
+    """
+    fname = raw.filenames[0]
+    t_log = store.get("raws", fname.name, {})
+    fingerprint = fingerprint_file(fname, cached=t_log.get("fingerprint"))
+    params = {k: float(v) for k, v in sorted(kwargs.items())}
+    prev = t_log.get("prescreen")
+    if (
+        prev is not None
+        and prev["hash"] == fingerprint["hash"]
+        and prev["params"] == params
+    ):
+        logger.info(f"Using previous screening of {fname.name}")
+        return prev["suggested"]
+
+    logger.info(f"Screening channels of {fname.name}")
+    scores = screen_channels(raw, **kwargs)
+    suggested = suggest_bads(scores)
+    logger.info(f"Suggested bad channels {suggested}")
+    _update_fingerprint(fname, t_log)
+    t_log["prescreen"] = {
+        "hash": fingerprint["hash"],
+        "params": params,
+        "ch_names": scores["ch_names"],
+        "scores": {
+            k: [None if np.isnan(x) else float(f"{x:.6g}") for x in v]
+            for k, v in scores.items()
+            if k != "ch_names"
+        },
+        "suggested": suggested,
+    }
+    store.set("raws", fname.name, t_log)
+    return suggested
+
+
+# Drop reasons of the epochs screening, as they appear in the drop log
+_EPOCH_REASONS = {
+    "ptp": "PRESCREEN_PTP",
+    "flat": "PRESCREEN_FLAT",
+    "variance": "PRESCREEN_VARIANCE",
+}
+
+_DEFAULT_THRESHOLDS = (50e-6, 75e-6, 100e-6, 150e-6, 200e-6, 300e-6, 500e-6)
+
+
+def screen_epochs(epochs, n_epochs=100):
+    """
+    Compute the peak-to-peak amplitude and variance of each epoch and good
+    EEG channel.
+
+    The data is read n_epochs at a time, so unloaded or memory-mapped epochs
+    are never copied in full. Returns arrays of shape
+    (n_epochs, n_channels).
+    """
+    picks = mne.pick_types(epochs.info, eeg=True, exclude="bads")
+    shape = (len(epochs), len(picks))
+    ptp = np.empty(shape)
+    variance = np.empty(shape)
+    for start in range(0, len(epochs), n_epochs):
+        stop = min(start + n_epochs, len(epochs))
+        data = epochs.get_data(picks=picks, item=slice(start, stop))
+        ptp[start:stop] = np.ptp(data, axis=-1)
+        variance[start:stop] = np.var(data, axis=-1)
+    return {
+        "ch_names": [epochs.ch_names[x] for x in picks],
+        "ptp": ptp,
+        "variance": variance,
+    }
+
+
+def sweep_thresholds(scores, thresholds=_DEFAULT_THRESHOLDS):
+    """
+    Count the epochs that each peak-to-peak threshold would drop.
+    """
+    max_ptp = scores["ptp"].max(axis=1, initial=0)
+    thresholds = np.asarray(thresholds)
+    n_dropped = np.sum(max_ptp[:, None] > thresholds[None, :], axis=0)
+    return dict(zip(thresholds.tolist(), n_dropped.tolist()))
+
+
+def suggest_epochs(scores, ptp=100e-6, flat=1e-6, z_thresh=5.0):
+    """
+    Get the epochs to suggest as bad from the scores of screen_epochs.
+
+    An epoch is suggested if any channel has a peak-to-peak amplitude above
+    ptp or below flat, or if its mean log-variance is an outlier. Returns a
+    dict with the reasons (ptp, flat or variance) for each suggested epoch
+    index.
+    """
+    log_variance = np.log10(np.maximum(scores["variance"], 1e-30)).mean(1)
+    reasons = {
+        "ptp": np.any(scores["ptp"] > ptp, axis=1),
+        "flat": np.any(scores["ptp"] < flat, axis=1),
+        "variance": np.abs(_robust_z(log_variance)) > z_thresh,
+    }
+    mask = np.any(list(reasons.values()), axis=0)
+    return {
+        int(idx): [k for k, v in reasons.items() if v[idx]]
+        for idx in np.flatnonzero(mask)
+    }
+
+
+def prescreen_epochs(epochs, store, ptp=100e-6, drop=True, **kwargs):
+    """
+    Screen the epochs read from a file and drop the suggested ones.
+
+    The number of epochs dropped by a sweep of peak-to-peak thresholds is
+    reported, and the epochs suggested with the ptp threshold are dropped
+    (if drop is True) with the reasons in _EPOCH_REASONS. The sweep and the
+    suggested epochs (as indices of the original events) are recorded in
+    the log. kwargs are passed to suggest_epochs.
+    """
+    fname = epochs.filename
+    logger.info(f"Screening epochs of {fname.name}")
+    scores = screen_epochs(epochs)
+    sweep = sweep_thresholds(scores)
+    n_epochs = len(epochs)
+    for threshold, n_dropped in sweep.items():
+        logger.info(
+            f"Peak-to-peak {threshold * 1e6:g} uV: drops {n_dropped} of "
+            f"{n_epochs} epochs"
+        )
+    suggested = suggest_epochs(scores, ptp=ptp, **kwargs)
+    selection = epochs.selection.copy()
+
+    if drop is True:
+        groups = {}
+        for idx, reasons in suggested.items():
+            groups.setdefault(tuple(reasons), []).append(selection[idx])
+        for reasons, orig_idx in groups.items():
+            drop_idx = np.flatnonzero(np.isin(epochs.selection, orig_idx))
+            epochs.drop(
+                drop_idx, reason=[_EPOCH_REASONS[x] for x in reasons]
+            )
+
+    t_log = store.get("epochs", fname.name, {})
+    _update_fingerprint(fname, t_log)
+    t_log["prescreen"] = {
+        "params": {"ptp": ptp, **kwargs},
+        "sweep": [[k, v] for k, v in sweep.items()],
+        "selection": [int(selection[x]) for x in suggested],
+        "reasons": list(suggested.values()),
+    }
+    store.set("epochs", fname.name, t_log)
+    return suggested
@@ -20,16 +20,239 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 #
+import dataclasses
 import json
 
 import matplotlib.pyplot as plt
 import mne
 import numpy as np
-from mne.utils import logger
+from matplotlib.figure import Figure
+from mne.parallel import parallel_func
+from mne.report.report import _ContentElement, _fig_to_img
+from mne.stats.parametric import _parametric_ci
+from mne.time_frequency import psd_array_multitaper
+from mne.utils import check_random_state, logger
 from mne.viz.ica import _create_properties_layout
+from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
+from scipy.stats import gaussian_kde
 
+from .fingerprint import fingerprint_file, fingerprint_ica
+from .pca import _iter_chunks
 
-def create_ica_report(ica, epochs, filename, ncomponents=None):
+
+def _get_sources(ica, data, unmixing):
+    """Project epochs data with the unmixing matrix of some components
+    data is of shape (n_epochs, n_channels, n_times), with the ICA channels.
+    Returns an array of shape (n_epochs, n_components, n_times).
+    """
+    n_epochs, _, n_times = data.shape
+    data = ica._pre_whiten(np.hstack(data))
+    if ica.pca_mean_ is not None:
+        data -= ica.pca_mean_[:, None]
+    sources = np.dot(unmixing, data)
+    return sources.reshape(len(unmixing), n_epochs, n_times).transpose(1, 0, 2)
+
+
+def _compute_properties(ica, epochs, picks, n_epochs=100):
+    """Compute the sources, spectra and variance of the components in picks
+    The epochs are read and projected n_epochs at a time into preallocated
+    arrays, so only one block of the channels data is in memory. Returns
+    the sources, of shape (n_epochs, n_picks, n_times), the PSDs in dB, of
+    shape (n_epochs, n_picks, n_freqs), the frequencies and the variance of
+    each epoch, of shape (n_epochs, n_picks).
+    """
+    sfreq = epochs.info["sfreq"]
+    fmax = min(epochs.info["lowpass"] * 1.25, sfreq / 2.0)
+    unmixing = np.dot(
+        ica.unmixing_matrix_[picks], ica.pca_components_[: ica.n_components_]
+    )
+    sources = np.empty((len(epochs), len(picks), len(epochs.times)))
+    variance = np.empty((len(epochs), len(picks)))
+    psds = None
+    for start, stop, data in _iter_chunks(
+        epochs, ica._get_picks(epochs), n_epochs
+    ):
+        sources[start:stop] = _get_sources(ica, data, unmixing)
+        variance[start:stop] = np.var(sources[start:stop], axis=-1)
+        # The spectra only depend on the number of samples, so they are the
+        # same computed by blocks of epochs
+        t_psds, freqs = psd_array_multitaper(
+            sources[start:stop], sfreq, fmax=fmax, verbose=False
+        )
+        if psds is None:
+            psds = np.empty((len(epochs), len(picks), len(freqs)))
+        psds[start:stop] = 10 * np.log10(
+            np.maximum(t_psds, np.finfo(float).tiny)
+        )
+    return sources, psds, freqs, variance
+
+
+def _plot_properties(
+    axes, ica, pick, epochs_src, psds, freqs, variance, info, topomap_args
+):
+    """Plot the properties of a component as ica.plot_properties does
+    epochs_src holds the source of the component, psds its spectra
+    (n_epochs, n_freqs) and variance its variance (n_epochs,).
+    """
+    topo_ax, image_ax, erp_ax, spec_ax, var_ax = axes
+
+    ica.plot_components(picks=pick, axes=topo_ax, show=False, **topomap_args)
+
+    mne.viz.plot_epochs_image(
+        epochs_src,
+        picks=[0],
+        axes=[image_ax, erp_ax],
+        combine=None,
+        colorbar=False,
+        show=False,
+        ts_args={
+            "truncate_xaxis": False,
+            "show_sensors": False,
+            "ci": _parametric_ci,
+        },
+    )
+    image_ax.set_title("Epochs image and ERP/ERF")
+    image_ax.set_ylabel("Epochs")
+    image_ax.set_xticks([])
+    image_ax.set_ylim([-0.5, len(variance) + 0.5])
+    erp_ax.set_xlabel("Time (s)")
+    erp_ax.set_ylabel("AU")
+    erp_ax.set_xlim(epochs_src.times[[0, -1]])
+
+    # The power of each frequency is skewed, so the spread is computed
+    # separately below and above the mean
+    psd_mean = psds.mean(axis=0)
+    diffs = psds - psd_mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        below = np.sqrt(
+            np.sum(np.where(diffs < 0, diffs, 0) ** 2, axis=0)
+            / np.sum(diffs < 0, axis=0)
+        )
+        above = np.sqrt(
+            np.sum(np.where(diffs > 0, diffs, 0) ** 2, axis=0)
+            / np.sum(diffs > 0, axis=0)
+        )
+    spec_ax.plot(freqs, psd_mean, color="k")
+    spec_ax.fill_between(
+        freqs, psd_mean - below, psd_mean + above, color="k", alpha=0.2
+    )
+    lowpass = info["lowpass"]
+    if lowpass < info["sfreq"] / 2.0 and freqs[-1] > lowpass:
+        spec_ax.axvline(lowpass, lw=2, linestyle="--", color="k", alpha=0.2)
+    spec_ax.set_title("Spectrum")
+    spec_ax.set_xlabel("Frequency (Hz)")
+    spec_ax.set_ylabel("Power (dB)")
+    spec_ax.set_xlim(freqs[[0, -1]])
+
+    hist_ax = make_axes_locatable(var_ax).append_axes(
+        "right", size="33%", pad="2.5%", sharey=var_ax
+    )
+    var_ax.scatter(
+        np.arange(len(variance)), variance, alpha=0.5, facecolor="k", lw=0
+    )
+    hist_ax.hist(variance, orientation="horizontal", color="k", alpha=0.5)
+    try:
+        kde = gaussian_kde(variance)
+    except np.linalg.LinAlgError:
+        pass
+    else:
+        x = np.linspace(variance.min(), variance.max(), 50)
+        density = kde(x)
+        density *= hist_ax.get_xlim()[-1] * 0.9 / (density.max() or 1.0)
+        hist_ax.plot(density, x, color="k")
+    var_ax.set_title("Dropped segments: 0.00 %")
+    var_ax.set_xlabel("Epochs")
+    var_ax.set_ylabel("Variance (AU)")
+    hist_ax.set_yticks([])
+    for ax in axes:
+        ax.tick_params("both", labelsize=8)
+
+
+def _render_component(
+    ica,
+    t_comp,
+    epochs_src,
+    psds,
+    freqs,
+    variance,
+    starts,
+    n_epochs,
+    info,
+    topomap_args,
+    image_format,
+):
+    """Render the page of a component and return it encoded as in a report
+    starts are the first epochs of the random windows of n_epochs epochs.
+    The figure does not use pyplot, so it can be rendered in any process.
+    """
+    fig = Figure(layout="constrained", figsize=(14, 6))
+    subfigs = fig.subfigures(1, 2, hspace=0.07)
+    _, axes = _create_properties_layout(fig=subfigs[0])
+    _plot_properties(
+        axes,
+        ica,
+        t_comp,
+        epochs_src,
+        psds,
+        freqs,
+        variance,
+        info,
+        topomap_args,
+    )
+    sources = epochs_src.get_data(picks=[0])[:, 0]
+    axes = subfigs[1].subplots(len(starts), 1)
+    for i, ax in zip(starts, axes):
+        data = sources[i : i + n_epochs]
+        ax.plot(np.hstack(data), lw=0.5, color="k")
+        [
+            ax.axvline(data.shape[1] * x, ls="--", lw=0.2, color="k")
+            for x in range(n_epochs)
+        ]
+        ax.set_xticks(
+            ticks=[x * data.shape[1] for x in range(n_epochs)],
+            labels=[x * epochs_src.times[-1] for x in range(n_epochs)],
+        )
+    ax.set_ylabel("Amplitude (uV)")
+    ax.set_xlabel("Time (s)")
+    return _fig_to_img(fig, image_format=image_format, own_figure=False)
+
+
+def _add_cached(report, cache, key, add):
+    """Call add() to add content to the report, or restore it from the cache
+    The elements added by add() are stored in cache under key. If key is
+    None, nothing is cached.
+    """
+    if key is not None:
+        text = cache.load_text(key)
+        if text is not None:
+            for element in json.loads(text):
+                element["tags"] = tuple(element["tags"])
+                report._content.append(_ContentElement(**element))
+            return
+    n_content = len(report._content)
+    add()
+    if key is not None:
+        elements = report._content[n_content:]
+        cache.save_text(
+            key, json.dumps([dataclasses.asdict(x) for x in elements])
+        )
+
+
+def create_ica_report(
+    ica,
+    epochs,
+    filename,
+    ncomponents=None,
+    n_jobs=1,
+    cache=None,
+    random_state=0,
+):
+    """Create the report to review the components of ica
+    If cache is a DiskCache, each section and component page is stored in
+    it, keyed by the fingerprints of the ICA and epochs and the plotting
+    parameters, and only what is missing is rendered again. random_state
+    seeds the random windows of the component pages.
+    """
     outlines = "head"
 
     topomap_args = {"outlines": outlines}
@@ -45,6 +268,25 @@ def create_ica_report(ica, epochs, filename, ncomponents=None):
 
     report = mne.Report(title="Cleaning report")
 
+    base_key = None
+    if cache is not None and epochs.filename is not None:
+        base_key = [
+            fingerprint_ica(ica)["hash"],
+            sorted(ica.exclude),
+            fingerprint_file(epochs.filename)["hash"],
+            sorted(epochs.info["bads"]),
+            epochs.ch_names,
+            epochs.selection.tolist(),
+            report.image_format,
+            topomap_args,
+            mne.__version__,
+        ]
+
+    def _key(*parts):
+        if base_key is None:
+            return None
+        return cache.key("create_ica_report", *parts, *base_key)
+
     style_start = """
     <style type="text/css">
         div.ica_menu,
@@ -200,32 +442,40 @@ def create_ica_report(ica, epochs, filename, ncomponents=None):
     t_event_id = {
         k: v for k, v in epochs.event_id.items() if v in unique_events
     }
-    report.add_events(
-        events=epochs.events,
-        event_id=t_event_id,
-        title='Events from "events"',
-        sfreq=epochs.info["sfreq"],
+    _add_cached(
+        report,
+        cache,
+        _key("events"),
+        lambda: report.add_events(
+            events=epochs.events,
+            event_id=t_event_id,
+            title='Events from "events"',
+            sfreq=epochs.info["sfreq"],
+        ),
     )
 
-    report.add_epochs(
-        epochs=epochs,
-        title="Epochs",
-    )
-
-    report._add_ica_overlay(
-        ica=ica,
-        inst=epochs,
-        image_format=report.image_format,
-        section="ICA Overlay",
-        replace=True,
-        tags=["ica_overlay"],
+    _add_cached(
+        report,
+        cache,
+        _key("epochs"),
+        lambda: report.add_epochs(
+            epochs=epochs,
+            title="Epochs",
+        ),
     )
 
-    fig_comps = ica.plot_components(
-        inst=epochs,
-        outlines=outlines,
-        picks=range(ncomponents),
-        show=False,
+    _add_cached(
+        report,
+        cache,
+        _key("ica_overlay"),
+        lambda: report._add_ica_overlay(
+            ica=ica,
+            inst=epochs,
+            image_format=report.image_format,
+            section="ICA Overlay",
+            replace=True,
+            tags=["ica_overlay"],
+        ),
     )
 
     overall_comment = """
@@ -237,63 +487,105 @@ def create_ica_report(ica, epochs, filename, ncomponents=None):
 
     </div>"""
 
-    report.add_figure(
-        fig=fig_comps,
-        title="ICA components",
-        caption="Topographies",
-        section="Overall",
-    )
-    report.add_html(
-        html=overall_comment.format(json_fname.name),
-        title="ICA components",
-        section="Overall",
+    def _add_overall():
+        fig_comps = ica.plot_components(
+            inst=epochs,
+            outlines=outlines,
+            picks=range(ncomponents),
+            show=False,
+        )
+        report.add_figure(
+            fig=fig_comps,
+            title="ICA components",
+            caption="Topographies",
+            section="Overall",
+        )
+        report.add_html(
+            html=overall_comment.format(json_fname.name),
+            title="ICA components",
+            section="Overall",
+        )
+        plt.close(fig_comps)
+
+    _add_cached(
+        report,
+        cache,
+        _key("overall", ncomponents, json_fname.name),
+        _add_overall,
     )
-    plt.close(fig_comps)
 
-    all_figs = []
-    captions = []
-    sources = ica.get_sources(epochs).get_data()
-    n_sources = sources.shape[0]
+    n_sources = len(epochs)
     n_random = 5
     n_epochs = 5
-    for t_comp in range(ncomponents):
-        logger.info(f"Plotting component {t_comp+1} of {ncomponents}")
-        fig = plt.figure(layout="constrained", figsize=(14, 6))
-        subfigs = fig.subfigures(1, 2, hspace=0.07)
-        t_prop_fig, axes = _create_properties_layout(fig=subfigs[0])
-        ica.plot_properties(
-            inst=epochs,
-            picks=t_comp,
-            axes=axes,
-            topomap_args=topomap_args,
-            show=False,
+    rng = check_random_state(random_state)
+    idx = rng.randint(n_sources - n_epochs, size=(ncomponents, n_random))
+    keys = [
+        _key("component", t_comp, idx[t_comp].tolist(), n_epochs)
+        for t_comp in range(ncomponents)
+    ]
+    imgs = [None if x is None else cache.load_text(x) for x in keys]
+    missing = [t_comp for t_comp, x in enumerate(imgs) if x is None]
+    if len(missing) < ncomponents:
+        logger.info(f"Using {ncomponents - len(missing)} cached components")
+
+    if len(missing) > 0:
+        # The plotted components are projected once for all the figures
+        sources, psds, freqs, variance = _compute_properties(
+            ica, epochs, np.array(missing)
         )
-        idx = np.random.randint(n_sources - n_epochs, size=n_random)
-        axes = subfigs[1].subplots(n_random, 1)
-        for i, ax in zip(idx, axes):
-            data = sources[i : i + n_epochs, t_comp, :]
-            ax.plot(np.hstack(data), lw=0.5, color="k")
-            [
-                ax.axvline(data.shape[1] * x, ls="--", lw=0.2, color="k")
-                for x in range(n_epochs)
-            ]
-            ax.set_xticks(
-                ticks=[x * data.shape[1] for x in range(n_epochs)],
-                labels=[x * epochs.times[-1] for x in range(n_epochs)],
+        all_sources = []
+        for i_comp, t_comp in enumerate(missing):
+            src_info = mne.create_info(
+                [ica._ica_names[t_comp]], epochs.info["sfreq"], "misc"
+            )
+            all_sources.append(
+                mne.EpochsArray(
+                    sources[:, i_comp : i_comp + 1],
+                    src_info,
+                    events=epochs.events,
+                    tmin=epochs.tmin,
+                    event_id=epochs.event_id,
+                    verbose=False,
+                )
             )
-        ax.set_ylabel("Amplitude (uV)")
-        ax.set_xlabel("Time (s)")
-        all_figs.append(fig)
-        captions.append(
-            f"ICA component {t_comp+1} topographies and time series"
-        )
 
-    report.add_figure(
-        fig=all_figs,
-        caption=captions,
-        section="Properties",
+        logger.info(f"Rendering component figures (n_jobs = {n_jobs})")
+        parallel, p_fun, n_jobs = parallel_func(_render_component, n_jobs)
+        rendered = parallel(
+            p_fun(
+                ica,
+                t_comp,
+                all_sources[i_comp],
+                psds[:, i_comp],
+                freqs,
+                variance[:, i_comp],
+                idx[t_comp],
+                n_epochs,
+                epochs.info,
+                topomap_args,
+                report.image_format,
+            )
+            for i_comp, t_comp in enumerate(missing)
+        )
+        for t_comp, img in zip(missing, rendered):
+            imgs[t_comp] = img
+            if keys[t_comp] is not None:
+                cache.save_text(keys[t_comp], img)
+
+    captions = [
+        f"ICA component {t_comp+1} topographies and time series"
+        for t_comp in range(ncomponents)
+    ]
+    report._add_slider(
+        figs=None,
+        imgs=imgs,
         title="ICA properties",
+        captions=captions,
+        start_idx=0,
+        image_format=report.image_format,
+        tags=("custom-figure",),
+        section="Properties",
+        replace=False,
     )
-    [plt.close(x) for x in all_figs]
 
     return report
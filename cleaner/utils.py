@@ -21,8 +21,14 @@
 # applications.
 #
 import logging
+import os
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 
+import mne
+import numpy as np
+from mne._fiff.pick import _picks_to_idx
 from mne.utils import logger, set_log_file
 from mne.utils._logging import WrapStdOut
 
@@ -61,3 +67,79 @@ def remove_file_logging():
         if isinstance(h, logging.FileHandler):
             h.close()
             logger.removeHandler(h)
+
+
+@contextmanager
+def memmap_preload(fname, memmap_dir=None):
+    """Get the preload argument to load the data of fname
+    If memmap_dir is None, the data is loaded in memory (True). Otherwise, the
+    data is memory-mapped to a scratch file in memmap_dir, which is removed
+    when leaving the context.
+    """
+    if memmap_dir is None:
+        yield True
+        return
+    memmap_dir = Path(memmap_dir)
+    memmap_dir.mkdir(parents=True, exist_ok=True)
+    fd, scratch_fname = tempfile.mkstemp(
+        prefix=f"{Path(fname).stem}-", suffix=".dat", dir=memmap_dir
+    )
+    os.close(fd)
+    logger.info(f"Memory-mapping data to {scratch_fname}")
+    try:
+        yield scratch_fname
+    finally:
+        try:
+            os.unlink(scratch_fname)
+        except OSError:
+            # Still mapped on some platforms, e.g. Windows
+            logger.warning(f"Could not remove {scratch_fname}")
+
+
+def load_data(inst, preload=True, n_epochs=100, picks=None):
+    """Load the data of a Raw or Epochs instance in place
+    If preload is a file name, the data is loaded into a memory-mapped file
+    instead of memory. Epochs are loaded n_epochs at a time. If picks is set,
+    only these channels are loaded, so a memory-mapped array is never copied
+    by picking it afterwards.
+    """
+    if inst.preload:
+        return inst if picks is None else inst.pick(picks)
+    if isinstance(inst, mne.io.BaseRaw):
+        # Picking an unloaded Raw does not read any data
+        if picks is not None:
+            inst.pick(picks)
+        if preload is True:
+            return inst.load_data()
+        inst._preload_data(str(preload))
+        return inst
+
+    if preload is True and picks is None:
+        return inst.load_data()
+    picks = _picks_to_idx(inst.info, picks, exclude=())
+    shape = (len(inst), len(picks), len(inst.times))
+    if preload is True:
+        data = np.empty(shape)
+    else:
+        data = np.memmap(preload, mode="w+", dtype=np.float64, shape=shape)
+    # Same as BaseEpochs.load_data (checked against mne 1.13), but filling
+    # only the picked channels. The private attributes set below mirror it.
+    for start in range(0, len(inst), n_epochs):
+        stop = min(start + n_epochs, len(inst))
+        data[start:stop] = inst._get_data(
+            picks=picks, item=slice(start, stop)
+        )
+    inst.preload = True
+    inst._do_baseline = False
+    inst._decim_slice = slice(None, None, None)
+    inst._decim = 1
+    inst._raw_times = inst.times
+    inst._raw = None
+    # Pick the channels on an empty array, then set the loaded data
+    inst._data = np.empty((len(inst), inst.info["nchan"], 0))
+    inst.pick(picks)
+    inst._data = data
+    # Guard against changes of the mne internals mirrored above
+    assert inst._data.shape == shape
+    assert (len(inst), inst.info["nchan"], len(inst.times)) == shape
+    return inst
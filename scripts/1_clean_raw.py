@@ -27,14 +27,26 @@ from pathlib import Path
 import mne
 from mne.utils import logger
 
-from cleaner import reject, update_log, is_cleaned
-from cleaner.utils import configure_logging, remove_file_logging
+from cleaner import LogStore, reject, update_log
+from cleaner.cache import DiskCache, filter_raw
+from cleaner.discovery import find_files
+from cleaner.index import StudyIndex
+from cleaner.overview import get_pyramid, plot_overview
+from cleaner.prefetch import prefetch
+from cleaner.prescreen import prescreen_raw
+from cleaner.utils import (
+    configure_logging,
+    memmap_preload,
+    remove_file_logging,
+)
 
 # Read a raw file, plot and select bad channels.
 
 default_scaling = 30e-6
 default_lpass = 40
 default_hpass = 1
+default_cache_size = 20
+default_prefetch = 4
 
 
 parser = ArgumentParser(description="Clean a RAW (continous) file.")
@@ -82,6 +94,42 @@ parser.add_argument(
     ),
 )
 
+parser.add_argument(
+    "--view-filter",
+    action="store_true",
+    help=(
+        "If set, the recording is not filtered before plotting. Instead, "
+        "the browser filters the data in view as it is scrolled."
+    ),
+)
+
+parser.add_argument(
+    "--overview",
+    action="store_true",
+    help=(
+        "If set, plot the min/max envelope of the whole recording next to "
+        "the browser. The envelope is stored next to the file."
+    ),
+)
+
+parser.add_argument(
+    "--prescreen",
+    action="store_true",
+    help=(
+        "If set, screen the channels before plotting and mark the suspicious "
+        "ones as bad. The scores are stored in the log."
+    ),
+)
+
+parser.add_argument(
+    "--headless",
+    action="store_true",
+    help=(
+        "If set, only screen the channels and store the scores in the log, "
+        "without plotting."
+    ),
+)
+
 parser.add_argument(
     "--pattern",
     metavar="pattern",
@@ -110,13 +158,67 @@ parser.add_argument(
         "has been done before."
     ),
 )
+
+parser.add_argument(
+    "--memmap",
+    metavar="memmap",
+    type=str,
+    default=None,
+    help=(
+        "Directory for scratch files. If set, the data is memory-mapped to "
+        "a file in this directory instead of being loaded in memory."
+    ),
+)
+
+parser.add_argument(
+    "--cache",
+    metavar="cache",
+    type=str,
+    default=None,
+    help=(
+        "Directory to cache the filtered data. If set, files opened again "
+        "with the same filter are not filtered again."
+    ),
+)
+
+parser.add_argument(
+    "--cache-size",
+    metavar="cache_size",
+    type=float,
+    default=default_cache_size,
+    help=(
+        "Maximum size of the cache in GB. The least recently used files "
+        f"are removed first. (Default {default_cache_size})"
+    ),
+)
+
+parser.add_argument(
+    "--prefetch",
+    metavar="prefetch",
+    type=float,
+    default=default_prefetch,
+    help=(
+        "Memory budget in GB to load the next file while the current one is "
+        "reviewed. If 0, files are loaded one at a time. "
+        f"(Default {default_prefetch})"
+    ),
+)
 args = parser.parse_args()
 path = args.path
 scaling = args.scaling
 hpass = args.hpass
 lpass = args.lpass
+view_filter = args.view_filter
+overview = args.overview
+headless = args.headless
+prescreen = args.prescreen or headless
 pattern = args.pattern
 redo = args.redo
+memmap = args.memmap
+cache = None
+if args.cache is not None:
+    cache = DiskCache(args.cache, max_size=int(args.cache_size * 1e9))
+prefetch_bytes = int(args.prefetch * 1e9)
 
 if isinstance(path, list):
     path = path[0]
@@ -148,27 +250,93 @@ else:
     if pattern is None:
         pattern = "**/eeg/**/*eeg.fif"
         logger.info(f"No pattern provided. Using default pattern {pattern}.")
-    raws = path.glob(pattern)
+    raws = find_files(path, pattern)
+
+# Only check the logs next to the files found, the index is kept in the
+# study directory so unchanged logs are not read again
+index = StudyIndex(path, cache_fname=True, dirs={x.parent for x in raws})
 
+to_clean = []
 for t_fname in raws:
-    if not redo and is_cleaned(t_fname, "raws"):
+    if not redo and index.is_cleaned(t_fname, "raws"):
         logger.info(f"File {t_fname} already cleaned. Skipping.")
         continue
+    to_clean.append(t_fname)
+
+
+def load_raw(t_fname, stack, cancelled):
+    """Read a raw file, mark the previous bad channels and filter it"""
+    store = LogStore(t_fname)
+    preload = stack.enter_context(memmap_preload(t_fname, memmap))
     logger.info(f"Loading file {t_fname}")
-    t_raw = mne.io.read_raw_fif(t_fname, preload=True)
+    t_raw = mne.io.read_raw_fif(t_fname, preload=False)
 
-    logger.info(f"Cleaning {t_fname}")
     # Mark previous bad channels
-    reject(t_fname, t_raw)
+    reject(t_fname, t_raw, store=store)
+
+    # A cancelled prefetch stops between the long steps
+    if cancelled.is_set():
+        return None
+    if prescreen is True:
+        suggested = prescreen_raw(t_raw, store)
+        # Only suggest on files that were not reviewed yet
+        if "bads" not in store.get("raws", t_fname.name, {}):
+            t_raw.info["bads"] = sorted(
+                set(t_raw.info["bads"]) | set(suggested)
+            )
+    if headless is True:
+        return store, t_raw, None
 
-    logger.info(f"Filtering {hpass} - {lpass}")
-    t_raw.filter(hpass, lpass)
+    # The envelope is computed before filtering, to show drifts
+    pyramid = get_pyramid(t_raw) if overview is True else None
+
+    if cancelled.is_set():
+        return None
+    if view_filter is False:
+        logger.info(f"Filtering {hpass} - {lpass}")
+        filter_raw(t_raw, hpass, lpass, cache=cache, preload=preload)
+    return store, t_raw, pyramid
+
+
+for t_fname, (store, t_raw, pyramid) in prefetch(
+    to_clean, load_raw, max_bytes=prefetch_bytes
+):
+    if headless is True:
+        store.commit()
+        continue
+
+    logger.info(f"Cleaning {t_fname}")
+    if view_filter is True:
+        # The browser reads and filters only the data in view
+        logger.info(f"Filtering {hpass} - {lpass} in view")
+        plot_kwargs = {
+            "highpass": hpass,
+            "lowpass": lpass,
+            "precompute": False,
+        }
+    else:
+        plot_kwargs = {}
 
     # Plot
-    t_raw.plot(block=True, scalings={"eeg": scaling}, n_channels=args.nchans)
+    if pyramid is not None:
+        overview_fig = plot_overview(
+            pyramid, bads=t_raw.info["bads"], scaling=scaling
+        )
+        overview_fig.show()
+    t_raw.plot(
+        block=True,
+        scalings={"eeg": scaling},
+        n_channels=args.nchans,
+        **plot_kwargs,
+    )
+    if pyramid is not None:
+        import matplotlib.pyplot as plt
+
+        plt.close(overview_fig)
 
     # Save new channels
-    update_log(t_fname, t_raw)
+    update_log(t_fname, t_raw, store=store)
+    store.commit()
 
 logger.info("Finished RAW cleaner")
 remove_file_logging()
@@ -25,17 +25,28 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 import mne
-import numpy as np
 from mne.utils import logger
-from sklearn.decomposition import PCA
 
-from cleaner import is_cleaned, reject, update_log
-from cleaner.utils import configure_logging, remove_file_logging
+from cleaner import LogStore, reject, update_log
+from cleaner.cache import DiskCache
+from cleaner.discovery import find_files
+from cleaner.index import StudyIndex
+from cleaner.pca import copy_decisions, make_pca_epochs
+from cleaner.prefetch import prefetch
+from cleaner.prescreen import prescreen_epochs
+from cleaner.utils import (
+    configure_logging,
+    load_data,
+    memmap_preload,
+    remove_file_logging,
+)
 
 # Read an epochs file, plot and select bad channels.
 
 default_scaling = 75e-6
 default_nepochs = 10
+default_prefetch = 4
+default_cache_size = 20
 
 parser = ArgumentParser(description="Clean an Epochs file.")
 parser.add_argument(
@@ -114,6 +125,63 @@ parser.add_argument(
     ),
 )
 
+parser.add_argument(
+    "--prescreen",
+    metavar="prescreen",
+    type=float,
+    default=None,
+    help=(
+        "Peak-to-peak threshold in uV. If set, the epochs are screened "
+        "before plotting and the ones above the threshold, flat or with an "
+        "abnormal variance are dropped. The results are stored in the log."
+    ),
+)
+
+parser.add_argument(
+    "--memmap",
+    metavar="memmap",
+    type=str,
+    default=None,
+    help=(
+        "Directory for scratch files. If set, the data is memory-mapped to "
+        "a file in this directory instead of being loaded in memory."
+    ),
+)
+
+parser.add_argument(
+    "--cache",
+    metavar="cache",
+    type=str,
+    default=None,
+    help=(
+        "Directory to cache the PCA components. If set, files opened again "
+        "are not decomposed again."
+    ),
+)
+
+parser.add_argument(
+    "--cache-size",
+    metavar="cache_size",
+    type=float,
+    default=default_cache_size,
+    help=(
+        "Maximum size of the cache in GB. The least recently used files "
+        f"are removed first. (Default {default_cache_size})"
+    ),
+)
+
+parser.add_argument(
+    "--prefetch",
+    metavar="prefetch",
+    type=float,
+    default=default_prefetch,
+    help=(
+        "Memory budget in GB to load the next file while the current one is "
+        "reviewed. If 0, files are loaded one at a time. "
+        f"(Default {default_prefetch})"
+    ),
+)
+
 args = parser.parse_args()
 path = args.path
 scaling = args.scaling
@@ -122,6 +190,12 @@ pattern = args.pattern
 redo = args.redo
 reset = args.reset
 n_pca = args.pca
+prescreen = args.prescreen
+memmap = args.memmap
+prefetch_bytes = int(args.prefetch * 1e9)
+cache = None
+if args.cache is not None:
+    cache = DiskCache(args.cache, max_size=int(args.cache_size * 1e9))
 
 if isinstance(path, list):
     path = path[0]
@@ -151,61 +225,73 @@ else:
     if pattern is None:
         pattern = "**/eeg/**/*eeg_epo.fif"
         logger.info(f"No pattern provided. Using default pattern {pattern}.")
-    epochs = path.glob(pattern)
+    epochs = find_files(path, pattern)
 
 
+# Only check the logs next to the files found, the index is kept in the
+# study directory so unchanged logs are not read again
+index = StudyIndex(path, cache_fname=True, dirs={x.parent for x in epochs})
+
+to_clean = []
 for t_fname in epochs:
-    if not redo and is_cleaned(t_fname, "epochs"):
+    if not redo and index.is_cleaned(t_fname, "epochs"):
         logger.info(f"File {t_fname} already cleaned. Skipping.")
         continue
+    to_clean.append(t_fname)
+
 
+def load_epochs(t_fname, stack, cancelled):
+    """Read an epochs file, drop the previous bad epochs and add the PCA"""
+    store = LogStore(t_fname)
+    preload = stack.enter_context(memmap_preload(t_fname, memmap))
     logger.info(f"Loading file {t_fname}")
     t_epochs = mne.read_epochs(
         t_fname,
-        preload=True,
+        preload=False,
     )
-    logger.info(f"Cleaning {t_fname}")
 
     # selection = t_epochs.selection
     # Mark previous bad epochs
     if reset is False:
         logger.info("Setting previous bad epochs")
-        reject(path, t_epochs)
+        reject(t_fname, t_epochs, store=store)
 
-    if n_pca > 0:
-        pca = mne.decoding.UnsupervisedSpatialFilter(PCA(n_pca), average=False)
-        logger.info("Fitting PCA (n_pca = {})".format(n_pca))
-        picks = mne.pick_types(
-            t_epochs.info,
-            meg=False,
-            eeg=True,
-            eog=False,
-            stim=False,
-            exclude="bads",
+    # A cancelled prefetch stops between the long steps
+    if cancelled.is_set():
+        return None
+    # When memory-mapping, the data is not loaded, the browser reads it
+    if preload is True and n_pca == 0:
+        load_data(t_epochs, preload)
+
+    if cancelled.is_set():
+        return None
+    if prescreen is not None:
+        # Only drop on files that were not reviewed yet
+        reviewed = "selection" in store.get("epochs", t_fname.name, {})
+        prescreen_epochs(
+            t_epochs,
+            store,
+            ptp=prescreen * 1e-6,
+            drop=reset is True or not reviewed,
         )
-        pca_data = pca.fit_transform(t_epochs.get_data()[:, picks, :])
-        blank = np.zeros((pca_data.shape[0], 2, pca_data.shape[2]))
-        pca_data = np.concatenate([blank, pca_data], axis=1)
-        ch_names = ["Blank1", "Blank2"]
-        ch_names += ["PCA{}".format(x) for x in range(n_pca)]
-        ch_types = ["misc"] * len(ch_names)
-
-        pca_info = t_epochs.info.copy()
-        mapping = {k: "misc" for k in pca_info["ch_names"][: n_pca + 2]}
-        pca_info.set_channel_types(mapping)
-        pca_info = mne.pick_info(pca_info, list(range(n_pca + 2)))
-        rename = dict(
-            zip(
-                pca_info["ch_names"],
-                ["Blank1", "Blank2"] + [f"PCA{x}" for x in range(n_pca)],
-            )
+
+    if cancelled.is_set():
+        return None
+    plot_epochs = t_epochs
+    if n_pca > 0:
+        plot_epochs = make_pca_epochs(
+            t_epochs, n_pca, preload=preload, cache=cache
         )
-        pca_info.rename_channels(rename)
-        pca_epochs = mne.EpochsArray(pca_data, pca_info)
-        t_epochs.add_channels([pca_epochs])
+    return store, t_epochs, plot_epochs
+
+
+for t_fname, (store, t_epochs, plot_epochs) in prefetch(
+    to_clean, load_epochs, max_bytes=prefetch_bytes
+):
+    logger.info(f"Cleaning {t_fname}")
     # Plot
-    picks = mne.pick_types(t_epochs.info, eeg=True, misc=True)
-    t_epochs.plot(
+    picks = mne.pick_types(plot_epochs.info, eeg=True, misc=True)
+    plot_epochs.plot(
         block=True,
         n_epochs=nepochs,
         picks=picks,
@@ -213,8 +299,12 @@ for t_fname in epochs:
         n_channels=args.nchans,
     )
 
+    if plot_epochs is not t_epochs:
+        copy_decisions(plot_epochs, t_epochs)
+
     # Save new channels
-    update_log(t_fname, t_epochs)
+    update_log(t_fname, t_epochs, store=store)
+    store.commit()
 
 logger.info("Finished EPOCHS cleaner")
 remove_file_logging()
@@ -28,9 +28,17 @@ from pathlib import Path
 import mne
 from mne.utils import logger
 
-from cleaner import reject, update_log, is_cleaned
-from cleaner.report import create_ica_report
-from cleaner.utils import configure_logging, remove_file_logging
+from cleaner import LogStore, reject, update_log
+from cleaner.cache import DiskCache
+from cleaner.discovery import find_files
+from cleaner.index import StudyIndex
+from cleaner.prefetch import prefetch
+from cleaner.utils import (
+    configure_logging,
+    load_data,
+    memmap_preload,
+    remove_file_logging,
+)
 
 # Read an epochs file, and ica file, apply and plot.
 # Option A: Create report for ICA cleaning
@@ -38,6 +46,9 @@ from cleaner.utils import configure_logging, remove_file_logging
 
 default_scaling = 75e-6
 default_ncomps = 10
+default_prefetch = 4
+default_n_jobs = 1
+default_cache_size = 20
 
 parser = ArgumentParser(description="Apply ICA and clean.")
 parser.add_argument(
@@ -123,6 +134,62 @@ parser.add_argument(
     ),
 )
 
+parser.add_argument(
+    "--memmap",
+    metavar="memmap",
+    type=str,
+    default=None,
+    help=(
+        "Directory for scratch files. If set, the data is memory-mapped to "
+        "a file in this directory instead of being loaded in memory."
+    ),
+)
+
+parser.add_argument(
+    "--cache",
+    metavar="cache",
+    type=str,
+    default=None,
+    help=(
+        "Directory to cache the sections of the report. If set, only the "
+        "sections of files or ICAs that changed are rendered again."
+    ),
+)
+
+parser.add_argument(
+    "--cache-size",
+    metavar="cache_size",
+    type=float,
+    default=default_cache_size,
+    help=(
+        "Maximum size of the cache in GB. The least recently used files "
+        f"are removed first. (Default {default_cache_size})"
+    ),
+)
+
+parser.add_argument(
+    "--prefetch",
+    metavar="prefetch",
+    type=float,
+    default=default_prefetch,
+    help=(
+        "Memory budget in GB to load the next file while the current one is "
+        "reviewed. If 0, files are loaded one at a time. "
+        f"(Default {default_prefetch})"
+    ),
+)
+
+parser.add_argument(
+    "--n-jobs",
+    metavar="n_jobs",
+    type=int,
+    default=default_n_jobs,
+    help=(
+        "Number of processes to render the figures of the report. "
+        f"If -1, use all the CPUs. (Default {default_n_jobs})"
+    ),
+)
+
 
 args = parser.parse_args()
 path = args.path
@@ -133,6 +200,12 @@ interactive = args.interactive
 raw = args.raw
 apply = args.apply
 redo = args.redo
+memmap = args.memmap
+prefetch_bytes = int(args.prefetch * 1e9)
+n_jobs = args.n_jobs
+cache = None
+if args.cache is not None:
+    cache = DiskCache(args.cache, max_size=int(args.cache_size * 1e9))
 
 if isinstance(path, list):
     path = path[0]
@@ -173,10 +246,15 @@ else:
         else:
             pattern = "**/eeg/**/*eeg_epo.fif"
         logger.info(f"No pattern provided. Using default pattern {pattern}.")
-    fnames = path.glob(pattern)
+    fnames = find_files(path, pattern)
 
 reject_type = "raws" if raw is True else "epochs"
 
+# Only check the logs next to the files found, the index is kept in the
+# study directory so unchanged logs are not read again
+index = StudyIndex(path, cache_fname=True, dirs={x.parent for x in fnames})
+
+to_clean = []
 for t_fname in fnames:
     ica_fname = t_fname.parent / t_fname.name.replace(".fif", "-ica.fif")
     # We need an ICA decomposition
@@ -184,7 +262,8 @@ for t_fname in fnames:
         logger.info(f"ICA file {ica_fname} does not exist. Skipping.")
         continue
 
-    is_ica_cleaned = is_cleaned(ica_fname, "icas")
+    # ICA decisions are logged under the name of the cleaned file
+    is_ica_cleaned = index.is_cleaned(t_fname, "icas")
 
     # In order to apply, we need the file to be cleaned
     if apply and not is_ica_cleaned:
@@ -197,45 +276,75 @@ for t_fname in fnames:
 
 
     # Check if it was previously cleaned
-    if not is_cleaned(t_fname, reject_type):
+    if not index.is_cleaned(t_fname, reject_type):
         logger.info(
             f"File {t_fname} not cleaned. Please do the raw/epoch cleaning "
             "first. Skipping."
         )
         continue
 
+    to_clean.append(t_fname)
+
+
+def load_ica(t_fname, stack, cancelled):
+    """Read a file and its ICA, and load the data if the ICA is reviewed"""
+    store = LogStore(t_fname)
+    preload = stack.enter_context(memmap_preload(t_fname, memmap))
+    ica_fname = t_fname.parent / t_fname.name.replace(".fif", "-ica.fif")
     if raw is True:
         logger.info("Loading raw file")
-        inst = mne.io.read_raw_fif(t_fname, preload=True)
+        inst = mne.io.read_raw_fif(t_fname, preload=False)
     else:
         logger.info("Loading epochs file")
-        inst = mne.read_epochs(t_fname, preload=True)
+        inst = mne.read_epochs(t_fname, preload=False)
 
-    reject(t_fname, inst, required=True)
+    reject(t_fname, inst, required=True, store=store)
 
     ica = mne.preprocessing.read_ica(ica_fname, verbose=True)
 
-    inst.pick(ica.ch_names)
+    # A cancelled prefetch stops before loading the data
+    if cancelled.is_set():
+        return None
 
     results_fname = ica_fname.with_suffix(".json")
+    if interactive is True or not results_fname.exists():
+        # Load only the ICA channels, picking after loading copies the data
+        load_data(inst, preload, picks=ica.ch_names)
+        reject(t_fname, ica, store=store)
+    return store, inst, ica
+
+
+for t_fname, (store, inst, ica) in prefetch(
+    to_clean, load_ica, max_bytes=prefetch_bytes
+):
+    ica_fname = t_fname.parent / t_fname.name.replace(".fif", "-ica.fif")
+    results_fname = ica_fname.with_suffix(".json")
 
     if interactive is False and results_fname.exists():
         with open(results_fname, "r") as f:
             rejected = json.load(f)
         to_exclude = [int(x) for x in rejected["reject"]]
         ica.exclude = to_exclude
-        update_log(t_fname, ica)
+        update_log(t_fname, ica, store=store)
     elif interactive is True:
         # TODO: Plot ica sources
-        reject(t_fname, ica)
         ica.plot_sources(inst, block=True)
-        update_log(t_fname, ica)
+        update_log(t_fname, ica, store=store)
 
     else:
-        reject(t_fname, ica)
-        report = create_ica_report(ica, inst, ica_fname, ncomponents=ncomps)
+        from cleaner.report import create_ica_report
+
+        report = create_ica_report(
+            ica,
+            inst,
+            ica_fname,
+            ncomponents=ncomps,
+            n_jobs=n_jobs,
+            cache=cache,
+        )
         report_fname = ica_fname.parent / ica_fname.name.replace(
             "-ica.fif", "-ica-report.html"
         )
 
         report.save(report_fname, overwrite=True, open_browser=False)
+    store.commit()
@@ -0,0 +1,129 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from cleaner import LogStore, reject
+from cleaner.applier import _drop_positions
+
+
+# Time the replay of previously dropped epochs in reject, on epochs with
+# n_epochs events of which a fraction was dropped during the review.
+
+parser = ArgumentParser(description="Benchmark reject on many epochs.")
+parser.add_argument(
+    "--n-epochs",
+    metavar="n_epochs",
+    type=int,
+    default=50000,
+    help="Number of epochs (Default 50000).",
+)
+parser.add_argument(
+    "--dropped",
+    metavar="dropped",
+    type=float,
+    default=0.1,
+    help="Fraction of dropped epochs (Default 0.1).",
+)
+parser.add_argument(
+    "--max-time",
+    metavar="max_time",
+    type=float,
+    default=1e-3,
+    help=(
+        "Fail if mapping the dropped epochs takes longer than this time in "
+        "seconds (Default 1e-3)."
+    ),
+)
+args = parser.parse_args()
+
+mne.set_log_level("WARNING")
+rng = np.random.default_rng(0)
+n_epochs = args.n_epochs
+n_repeats = 5
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    # Small epochs, so the time is spent on the events and not the data
+    info = mne.create_info(["EEG001"], 100.0, "eeg")
+    events = np.column_stack(
+        [
+            np.arange(n_epochs) * 10,
+            np.zeros(n_epochs, dtype=int),
+            np.ones(n_epochs, dtype=int),
+        ]
+    )
+    epochs = mne.EpochsArray(
+        np.zeros((n_epochs, 1, 2)), info, events=events, verbose=False
+    )
+    fname = Path(tmp_dir) / "bench_epo.fif"
+    epochs.save(fname, verbose=False)
+
+    selection = np.sort(
+        rng.choice(
+            n_epochs, int(n_epochs * (1 - args.dropped)), replace=False
+        )
+    )
+    store = LogStore(fname)
+    store.set(
+        "epochs",
+        fname.name,
+        {
+            "bads": [],
+            "selection": selection.tolist(),
+            "params": {
+                "tmin": epochs.tmin,
+                "tmax": epochs.tmax,
+                "events": events[:, 0].tolist(),
+            },
+        },
+    )
+
+    times = []
+    for _ in range(100):
+        start = time.perf_counter()
+        _drop_positions(epochs.selection, selection, len(epochs.drop_log))
+        times.append(time.perf_counter() - start)
+    t_map = np.median(times)
+
+    times = []
+    for _ in range(n_repeats):
+        t_epochs = mne.read_epochs(fname, preload=False, verbose=False)
+        start = time.perf_counter()
+        reject(fname, t_epochs, store=store)
+        times.append(time.perf_counter() - start)
+        assert len(t_epochs) == len(selection)
+    t_reject = np.median(times)
+
+n_dropped = n_epochs - len(selection)
+print(f"{n_epochs} epochs, {n_dropped} dropped")
+print(f"Mapping the dropped epochs: {t_map * 1e3:.3f} ms")
+print(f"reject (with the event checks and drop): {t_reject * 1e3:.1f} ms")
+if t_map > args.max_time:
+    print(f"FAIL: mapping slower than {args.max_time * 1e3:g} ms")
+    sys.exit(1)
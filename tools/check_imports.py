@@ -0,0 +1,97 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+
+# Check that `import cleaner` and the --help of each script do not import
+# the slow parts of the scientific stack. These are only needed once a
+# file is processed, and importing them makes every start ~5x slower.
+
+heavy_modules = ["matplotlib", "scipy", "sklearn", "mne.viz", "mne.report"]
+
+root = Path(__file__).resolve().parent.parent
+
+# Run the command in a fresh interpreter and print the heavy modules loaded
+probe = """
+import runpy, sys
+heavy = {heavy!r}
+if {script!r} is None:
+    import cleaner
+else:
+    sys.argv = [{script!r}, "--help"]
+    try:
+        runpy.run_path({script!r}, run_name="__main__")
+    except SystemExit:
+        pass
+sys.stdout.flush()
+print("\\nLOADED", " ".join(x for x in heavy if x in sys.modules))
+"""
+
+parser = ArgumentParser(description="Check the import time of the cleaner.")
+parser.add_argument(
+    "--max-time",
+    metavar="max_time",
+    type=float,
+    default=None,
+    help="Fail if a check takes longer than this time in seconds.",
+)
+args = parser.parse_args()
+
+checks = [("import cleaner", None)]
+checks += [
+    (f"{x.name} --help", str(x))
+    for x in sorted((root / "scripts").glob("*.py"))
+]
+
+failed = False
+for name, script in checks:
+    code = probe.format(heavy=heavy_modules, script=script)
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=root,
+        env={**os.environ, "PYTHONPATH": str(root)},
+    )
+    elapsed = time.perf_counter() - start
+    lines = [x for x in out.stdout.splitlines() if x.startswith("LOADED")]
+    if out.returncode != 0 or len(lines) == 0:
+        print(f"FAIL {name}: could not run\n{out.stderr}")
+        failed = True
+        continue
+    loaded = lines[-1].split()[1:]
+    status = "OK"
+    if len(loaded) > 0:
+        status = f"FAIL (imports {', '.join(loaded)})"
+    elif args.max_time is not None and elapsed > args.max_time:
+        status = f"FAIL (slower than {args.max_time} s)"
+    failed = failed or status != "OK"
+    print(f"{status} {name}: {elapsed:.2f} s")
+
+sys.exit(1 if failed else 0)